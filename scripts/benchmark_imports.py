@@ -0,0 +1,61 @@
+from make_pypath import pathify
+pathify()
+import sys
+import os
+import subprocess
+import json
+
+# The package modules scripts import, and the dependencies that should only load on first use.
+# These are slow to import, so the package imports them inside the functions that use them
+# instead of at module level, and this script checks that importing a module leaves them unloaded
+MODULES = [
+    "iot_net_planner.prediction.prr_file",
+    "iot_net_planner.optimization.scip_model",
+    "iot_net_planner.geo.demand_grid",
+    "iot_net_planner.geo.estimate_facs",
+    "iot_net_planner.geo.plotting",
+    "iot_net_planner.prediction.xg_253features",
+    "iot_net_planner.prediction.lr_253features",
+    "iot_net_planner.prediction.onnx_pipeline",
+    "iot_net_planner.prediction.ml_models.los_model_3features",
+]
+HEAVY = ["osmnx", "contextily", "matplotlib", "torch", "xgboost", "statsmodels", "skl2onnx", "sklearn"]
+
+# Run in a fresh interpreter so nothing is already imported
+_PROBE = """
+import json, sys, time
+sys.path.append({src!r})
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def time_import(module, repeats=5):
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src')
+    probe = _PROBE.format(src=src, module=module, heavy=HEAVY)
+
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True)
+        if out.returncode != 0:
+            return None, out.stderr.strip().splitlines()[-1]
+        result = json.loads(out.stdout)
+        times.append(result['seconds'])
+    return min(times), result['heavy']
+
+def main(repeats=5):
+    for module in MODULES:
+        seconds, heavy = time_import(module, repeats)
+        if seconds is None:
+            print(f"{module:<60} failed: {heavy}")
+        else:
+            print(f"{module:<60} {seconds:7.3f}s  heavy: {', '.join(heavy) or 'none'}")
+
+if __name__ == "__main__":
+    args = list(sys.argv[1:])
+
+    if len(args) >= 1:
+        args[0] = int(args[0])
+
+    main(*args)
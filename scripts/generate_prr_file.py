@@ -40,9 +40,9 @@ dems = gpd.read_file(dem_file).to_crs(nyc_crs)
 
 facs['cost'] = np.ones(len(facs))
 facs['built'] = np.zeros(len(facs))
-facs['altitude'] = np.array([sampler.sample(x, y) for x, y in zip(facs.geometry.x, facs.geometry.y)])
+facs['altitude'] = sampler.batched_sample(facs.geometry.x, facs.geometry.y)
 facs['altitude'] += np.random.uniform(0.0, facs['altitude'].max(), len(facs))
-dems['altitude'] = np.array([sampler.sample(x, y) for x, y in zip(dems.geometry.x, dems.geometry.y)])
+dems['altitude'] = sampler.batched_sample(dems.geometry.x, dems.geometry.y)
 
 prr = CachedPRRModel(LOS3Features(dems, facs, sampler, model_file, standard_scalar))
 
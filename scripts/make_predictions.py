@@ -10,7 +10,7 @@ from iot_net_planner.geo.dsm_sampler import DSMSampler
 from iot_net_planner.prediction.prr_cache import CachedPRRModel
 from iot_net_planner.prediction.xg_253features import XG253Features
 
-def main(dsm_file, dem_file, fac_file, sc_path, xg_path, prr_out):
+def main(dsm_file, dem_file, fac_file, sc_path, xg_path, prr_out, batch_size=1, n_threads=None):
     dems = gpd.read_file(dem_file).to_crs(epsg=4326)
     facs = gpd.read_file(fac_file).to_crs(dems.crs)
 
@@ -21,13 +21,18 @@ def main(dsm_file, dem_file, fac_file, sc_path, xg_path, prr_out):
     facs = facs.to_crs(utm)
 
     with DSMSampler(utm, dsm_file, 0) as sampler:
-        model = CachedPRRModel(XG253Features(dems, facs, sampler, xg_path, sc_path))
+        model = CachedPRRModel(XG253Features(dems, facs, sampler, xg_path, sc_path, n_threads=n_threads))
 
-        model.save_prrs(prr_out, logging=True)
+        model.save_prrs(prr_out, logging=True, batch_size=batch_size)
 
 
 if __name__ == "__main__":
     args = list(sys.argv[1:])
-    
+
+    if len(args) >= 7:
+        args[6] = int(args[6])
+    if len(args) >= 8:
+        args[7] = int(args[7])
+
     main(*args)
     
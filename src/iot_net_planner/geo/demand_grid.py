@@ -2,9 +2,10 @@
 """
 
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
 import pandas as pd
 import numpy as np
+import json
 from fiona.drvsupport import supported_drivers
 import fiona
 supported_drivers['LIBKML'] = 'r'
@@ -34,16 +35,77 @@ def load_file(area_file: str, utm=None) -> gpd.GeoDataFrame:
 
 # Create a 2D array of points where each point is 
 # granularity units above, below, to the left, and to the right
-def _make_grid(area_frame, granularity):
+def _make_grid(area_frame, granularity, area=None):
     # Generate points
+    if area is None:
+        area = _prepared_area(area_frame)
+    xs, ys = _grid_coords(area_frame.total_bounds, granularity)
+
+    # Get intersection points
+    inside = np.flatnonzero(shapely.contains_xy(area, xs, ys))
+    return gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs[inside], ys[inside]), crs=area_frame.crs, index=inside)
+
+def _count_grid(area_frame, granularity, area):
+    # Count the points _make_grid would generate without building them
+    xs, ys = _grid_coords(area_frame.total_bounds, granularity)
+    return int(np.count_nonzero(shapely.contains_xy(area, xs, ys)))
+
+def _search_granularity(area_frame, area, target_points, hi, tolerance):
+    # Find the granularity whose grid count is closest to target_points, given a
+    # granularity hi whose grid has too few points. Counts change in jumps as
+    # whole rows and columns enter the area, so the search keeps a bracket of a
+    # too coarse and a too fine granularity and returns the best one it counted
+    counts = {}
+    def count(granularity):
+        if granularity not in counts:
+            counts[granularity] = _count_grid(area_frame, granularity, area)
+        return counts[granularity]
+
+    # One point covers about granularity**2 of the area, so start from there
     minx, miny, maxx, maxy = area_frame.total_bounds
+    size = area.area if area.area > 0 else (maxx - minx) * (maxy - miny)
+    lo = min(hi, np.sqrt(size / target_points))
+
+    # Refine lo until its grid has at least target_points, moving hi along
+    while count(lo) < target_points:
+        hi = lo
+        lo *= 0.95 * np.sqrt(max(count(lo), 1) / target_points)
+
+    # Counts grow about linearly in 1 / granularity**2, so interpolate the
+    # bracket in that space and fall back to bisecting it when that stalls.
+    # Stop once the bracket or any count is within tolerance. A count can jump
+    # by more than tolerance at one granularity, so also stop once the bracket
+    # is too narrow to matter
+    def close_enough():
+        best = min(abs(c - target_points) for c in counts.values())
+        return count(lo) - count(hi) < tolerance or best < tolerance or hi - lo <= 1e-4 * hi
+
+    while not close_enough():
+        x_lo, x_hi = lo ** -2, hi ** -2
+        x = x_hi + (target_points - count(hi)) * (x_lo - x_hi) / (count(lo) - count(hi))
+        mid = x ** -0.5
+        if not lo + 0.05 * (hi - lo) < mid < hi - 0.05 * (hi - lo):
+            mid = (lo + hi) / 2
+        if count(mid) < target_points:
+            hi = mid
+        else:
+            lo = mid
+
+    return min(counts, key=lambda granularity: abs(counts[granularity] - target_points))
+
+def _grid_coords(bounds, granularity):
+    # The coordinates of every grid cell in the bounds
+    minx, miny, maxx, maxy = bounds
     x_coords = np.arange(minx, maxx, granularity)
     y_coords = np.arange(miny, maxy, granularity)
-    points = [Point(x, y) for x in x_coords for y in y_coords]
+    xs, ys = np.meshgrid(x_coords, y_coords, indexing='ij')
+    return xs.ravel(), ys.ravel()
 
-    # Get intersection points
-    dems = gpd.GeoDataFrame(geometry=points, crs=area_frame.crs)
-    return dems[dems.geometry.apply(lambda point: any(area_frame.contains(point)))]
+def _prepared_area(area_frame):
+    # A single prepared geometry of the area for vectorized containment tests
+    area = shapely.union_all(np.asarray(area_frame.geometry))
+    shapely.prepare(area)
+    return area
 
 def add_alts(dems: gpd.GeoDataFrame, sampler) -> gpd.GeoDataFrame:
     """Add altitudes to a demand GeoDataFrame
@@ -90,6 +152,80 @@ def generate_grid(area_file: str, granularity: float, sampler=None, utm=None) ->
 
     return dems
 
+def stream_grid(area_file: str, out_path: str, granularity: float, sampler=None, utm=None, chunk_points=1_000_000) -> int:
+    """Generates the same grid as generate_grid, but streams it to a GeoParquet
+    file one band of columns at a time so that memory use is bounded by
+    chunk_points no matter how large the area is. The file can be loaded
+    with geopandas.read_parquet
+
+    :param area_file: a path to a kml file representing the area to
+        put demand points
+    :type area_file: str
+    :param out_path: the path to write the GeoParquet file to
+    :type out_path: str
+    :param granularity: one point will be placed every granularity units,
+        where units are the distance in the area_file's crs or supplied utm
+    :type granularity: float
+    :param sampler: a geo sampler to use to fill the altitude column.
+        If None there will be no altitude column, defaults to None
+    :type sampler: class: `iot_net_planner.geo.sampler.Sampler`, optional
+    :param utm: a crs for the area. If None then the area_file's crs 
+        is used, which may mean that granularity will be strange units,
+        defaults to None
+    :type utm: str, optional
+    :param chunk_points: roughly the number of grid cells tested and sampled
+        at a time, defaults to 1_000_000
+    :type chunk_points: int, optional
+    :returns: the number of demand points written
+    :rtype: int
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from pyproj import CRS
+
+    area_frame = load_file(area_file, utm)
+    area = _prepared_area(area_frame)
+
+    minx, miny, maxx, maxy = area_frame.total_bounds
+    x_coords = np.arange(minx, maxx, granularity)
+    y_coords = np.arange(miny, maxy, granularity)
+    band_width = max(1, chunk_points // max(1, len(y_coords)))
+
+    fields = [pa.field('geometry', pa.binary())]
+    if sampler is not None:
+        fields.append(pa.field('altitude', pa.float64()))
+    geo = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {
+            'encoding': 'WKB',
+            'geometry_types': ['Point'],
+            'crs': None if area_frame.crs is None else CRS.from_user_input(area_frame.crs).to_json_dict(),
+        }},
+    }
+    schema = pa.schema(fields, metadata={'geo': json.dumps(geo)})
+
+    written = 0
+    with pq.ParquetWriter(out_path, schema) as writer:
+        # Bands of x columns keep the same point order as generate_grid
+        for start in range(0, len(x_coords), band_width):
+            xs, ys = np.meshgrid(x_coords[start:start + band_width], y_coords, indexing='ij')
+            xs = xs.ravel()
+            ys = ys.ravel()
+            inside = shapely.contains_xy(area, xs, ys)
+            xs = xs[inside]
+            ys = ys[inside]
+            if len(xs) == 0:
+                continue
+
+            columns = [pa.array(shapely.to_wkb(shapely.points(xs, ys)), type=pa.binary())]
+            if sampler is not None:
+                columns.append(pa.array(np.asarray(sampler.batched_sample(xs, ys), dtype=np.float64)))
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            written += len(xs)
+
+    return written
+
 def generate_grid_with_points(area_file, target_points, sampler=None, utm=None):
     """Tries to generate a grid of demand points with roughly target_points 
     demand points the answer may not be exact
@@ -110,44 +246,19 @@ def generate_grid_with_points(area_file, target_points, sampler=None, utm=None):
     """
     tolerance = 5
     area_frame = load_file(area_file, utm)
+    area = _prepared_area(area_frame)
 
     # Generate points
     minx, miny, maxx, maxy = area_frame.total_bounds
-    
-    # Generate a grid with very few points
-    hi_granularity = 0.25 * min(maxx - minx, maxy - miny)
-    hi_dems = _make_grid(area_frame, hi_granularity)
-    # If the few points grid is still too many, just return the few
-    if len(hi_dems) >= target_points:
-        if sampler is not None:
-            return add_alts(hi_dems, sampler)
-        return hi_dems
-
-    # Generate grids with progressively more points until it exceeds the target
-    lo_granularity = 0.5 * hi_granularity
-    lo_dems = _make_grid(area_frame, lo_granularity)
-    while len(lo_dems) <= target_points:
-        lo_granularity *= 0.5
-        lo_dems = _make_grid(area_frame, lo_granularity)
-
-    # Binary search between the few and the many point grids
-    while len(hi_dems) + tolerance <= len(lo_dems):
-        mid_granularity = (lo_granularity + hi_granularity) / 2
-        mid_dems = _make_grid(area_frame, mid_granularity)
-
-        if len(mid_dems) == target_points:
-            break
-        elif len(mid_dems) < target_points:
-            hi_granularity = mid_granularity
-            hi_dems = _make_grid(area_frame, hi_granularity)
-        else:
-            lo_granularity = mid_granularity
-            lo_dems = _make_grid(area_frame, lo_granularity)
 
-    mid_granularity = (lo_granularity + hi_granularity) / 2
-    mid_dems = _make_grid(area_frame, mid_granularity)
+    # Use a grid with very few points if even that is too many
+    granularity = 0.25 * min(maxx - minx, maxy - miny)
+    if _count_grid(area_frame, granularity, area) < target_points:
+        granularity = _search_granularity(area_frame, area, target_points, granularity, tolerance)
+
+    dems = _make_grid(area_frame, granularity, area)
 
     if sampler is not None:
-        return add_alts(mid_dems, sampler)
+        return add_alts(dems, sampler)
 
-    return mid_dems
+    return dems
@@ -1,11 +1,39 @@
 """A tool for filling holes in a DSM using interpolation
 """
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
 import rasterio
 import numpy as np
 from rasterio.fill import fillnodata
+from rasterio.windows import Window
+
+def _fill_tile(input_file, band, threshold, max_search_distance, inner, outer):
+    # Fill one tile using the halo around it, returns the filled inner window
+    with rasterio.open(input_file) as src:
+        tile = src.read(band, window=inner)
+        if np.all(tile >= threshold):
+            return inner, tile
+        data = src.read(band, window=outer)
 
-def fill_file(input_file, output_file, band, threshold=-9000):
+    mask = data >= threshold
+    filled = fillnodata(data, mask=mask, max_search_distance=max_search_distance, smoothing_iterations=0)
+    row = inner.row_off - outer.row_off
+    col = inner.col_off - outer.col_off
+    return inner, filled[row:row + inner.height, col:col + inner.width]
+
+def _tile_windows(width, height, tile_size, halo):
+    # Yield each tile's window and the window padded by halo on every side
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            inner = Window(col, row, min(tile_size, width - col), min(tile_size, height - row))
+            row_start = max(0, row - halo)
+            col_start = max(0, col - halo)
+            row_stop = min(height, row + inner.height + halo)
+            col_stop = min(width, col + inner.width + halo)
+            yield inner, Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+def fill_file(input_file, output_file, band, threshold=-9000, max_search_distance=None, tile_size=None, n_workers=1):
     """Interpolate a DSM file to fill in holes
 
     :param input_file: a path to the DSM
@@ -14,19 +42,75 @@ def fill_file(input_file, output_file, band, threshold=-9000):
     :type output_file: str
     :param band: the 1-indexed band number to modify from the DSM
     :type band: int
-    :param threshold: values below this threshold will be interpolated, 
+    :param threshold: values below this threshold will be interpolated,
         defaults to -9000
     :type threshold: int, optional
+    :param max_search_distance: the maximum number of pixels to search
+        for values to interpolate from. If None, 10_000.0 when filling in memory
+        and tile_size when filling in tiles, defaults to None
+    :type max_search_distance: float, optional
+    :param tile_size: if not None, the DSM is filled out of core in square tiles
+        of tile_size pixels, and tiles with no holes are copied without interpolation.
+        Each tile is read with a halo of max_search_distance pixels so the result
+        matches filling the whole band with that search distance. The halo sets the
+        memory used per tile, about (tile_size + 2 * max_search_distance) ** 2 pixels,
+        so tiled filling defaults to a search distance of tile_size. Holes wider than
+        twice the search distance are then only partly filled; pass a larger
+        max_search_distance (and accept larger reads) or a larger tile_size to fill
+        them. If None, the whole band is filled in memory, defaults to None
+    :type tile_size: int, optional
+    :param n_workers: only used when tile_size is not None. The number of processes
+        filling tiles in parallel, defaults to 1
+    :type n_workers: int, optional
     """
+    if tile_size is not None:
+        if max_search_distance is None:
+            max_search_distance = float(tile_size)
+        return _fill_file_tiled(input_file, output_file, band, threshold, max_search_distance, tile_size, n_workers)
+
     with rasterio.open(input_file) as src:
         file_band = src.read(band)
-    
-        mask = file_band >= threshold   
-        filled_band = fillnodata(file_band, mask=mask, max_search_distance=10_000.0, smoothing_iterations=0)
-    
+
+        if max_search_distance is None:
+            max_search_distance = 10_000.0
+        mask = file_band >= threshold
+        filled_band = fillnodata(file_band, mask=mask, max_search_distance=max_search_distance, smoothing_iterations=0)
+
         profile = src.profile
         profile.update(count=1)
         with rasterio.open(output_file, 'w', **profile) as dst:
             dst.write(filled_band, 1)
 
+def _fill_file_tiled(input_file, output_file, band, threshold, max_search_distance, tile_size, n_workers):
+    # Fill the DSM tile by tile on a process pool, writing each tile as it finishes
+    halo = int(np.ceil(max_search_distance))
+    with rasterio.open(input_file) as src:
+        profile = src.profile
+        width, height = src.width, src.height
+    profile.update(count=1)
+
+    windows = _tile_windows(width, height, tile_size, halo)
+    args = (input_file, band, threshold, max_search_distance)
+
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        if n_workers <= 1:
+            for inner, outer in windows:
+                inner, filled = _fill_tile(*args, inner, outer)
+                dst.write(filled, 1, window=inner)
+            return
 
+        # Keep a bounded number of tiles in flight and write each one as soon
+        # as it finishes, so filled tiles never pile up behind a slow one
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            pending = set()
+            for inner, outer in windows:
+                pending.add(executor.submit(_fill_tile, *args, inner, outer))
+                if len(pending) < 2 * n_workers:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    inner, filled = future.result()
+                    dst.write(filled, 1, window=inner)
+            for future in wait(pending).done:
+                inner, filled = future.result()
+                dst.write(filled, 1, window=inner)
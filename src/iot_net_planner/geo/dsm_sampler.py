@@ -1,9 +1,14 @@
+import hashlib
+import json
+import os
+
 import numpy as np
 import rasterio as rio
-import geopandas as gpd
-from shapely.geometry import Point
+from rasterio.windows import Window
 
 from iot_net_planner.geo.sampler import LinkSampler
+from iot_net_planner.geo.raster_lookup import crs_transformer, to_raster_crs, xy_to_rowcol, gather, interpolate
+from iot_net_planner.geo.tile_cache import TileCache
 
 class DSMSampler(LinkSampler):
     """A link sampler that samples from a DSM. All DSM samplers should be cleaned up after use
@@ -17,13 +22,56 @@ class DSMSampler(LinkSampler):
     :param band: the 0-indexed DSM band to use, can be None if only one band is present,
         defaults to None.
     :type band: int, optional
+    :param mode: how samples are read from the raster. 'sample' reads each point through
+        rasterio, 'array' reads the band (or the window given by bounds) into memory once
+        and samples it with numpy indexing, 'tiled' decodes the raster one tile at a time
+        into an LRU cache for rasters that do not fit in memory, defaults to 'sample'
+    :type mode: str, optional
+    :param bounds: only used when mode is 'array'. A (minx, miny, maxx, maxy) tuple in crs
+        of the area that will be sampled. Only this window of the raster is kept in memory
+        and points outside of it are given the nodata value, or 0 if the raster has none.
+        If None, the whole band is read, defaults to None
+    :type bounds: tuple, optional
+    :param tile_size: only used when mode is 'tiled'. A (rows, cols) tuple giving the shape
+        of each cached tile. If None, the raster's internal block shape is used when the raster
+        is tiled, otherwise (such as for a striped TIFF) tiles are about 256 by 256 pixels with
+        a height that is a multiple of the strip height, defaults to None
+    :type tile_size: tuple, optional
+    :param cache_bytes: only used when mode is 'tiled'. The memory budget of the tile
+        cache in bytes, defaults to 256 MiB
+    :type cache_bytes: int, optional
+    :param interpolation: how values between pixel centers are found. One of 'nearest',
+        'bilinear', or 'bicubic'. Interpolating allows a coarser DSM to be used without
+        losing much line of sight accuracy, defaults to 'nearest'
+    :type interpolation: str, optional
     """
-    def __init__(self, crs, raster_path, band=None):
+    def __init__(self, crs, raster_path, band=None, mode='sample', bounds=None, tile_size=None, cache_bytes=256 * 2**20, interpolation='nearest'):
         """Constructor method       
         """
+        if mode not in ('sample', 'array', 'tiled'):
+            raise ValueError(f"Unknown mode '{mode}', expected 'sample', 'array', or 'tiled'")
+        if interpolation not in ('nearest', 'bilinear', 'bicubic'):
+            raise ValueError(f"Unknown interpolation '{interpolation}', expected 'nearest', 'bilinear', or 'bicubic'")
         self._band = band
         self._raster = rio.open(raster_path)
         self._crs = crs
+        self._mode = mode
+        self._interpolation = interpolation
+        self._nodata = self._raster.nodata
+        self._fill = 0 if self._nodata is None else self._nodata
+        self._band_index = 1 if band is None else band + 1
+
+        # Build the reprojection once, points already in the raster's crs skip it entirely
+        self._transformer = crs_transformer(crs, self._raster.crs)
+
+        if mode == 'array':
+            self._read_window(bounds)
+        elif mode == 'tiled':
+            if tile_size is None:
+                tile_size = self._default_tile_size()
+            self._tile_size = tile_size
+            self._tile_cols = -(-self._raster.width // tile_size[1])
+            self._tiles = TileCache(self._read_tile, cache_bytes)
     
     def sample(self, x, y):
         """Return the raster sample at x, y
@@ -35,7 +83,7 @@ class DSMSampler(LinkSampler):
         :returns: the sample at (x, y)
         :rtype: float
         """
-        return self.batched_sample(np.array(x), np.array(y))[0]
+        return self.batched_sample(np.atleast_1d(x), np.atleast_1d(y))[0]
 
     def batched_sample(self, xs, ys):
         """Return a numpy array of the samples at the points defined by xs and ys
@@ -47,16 +95,121 @@ class DSMSampler(LinkSampler):
         :returns: the samples at the provided points
         :rtype: np.ndarray
         """
-        geo_points = gpd.GeoSeries([Point(x, y) for x, y in zip(xs, ys)], crs=self._crs).to_crs(self._raster.crs)
-        xs = geo_points.geometry.x
-        ys = geo_points.geometry.y
+        xs, ys = to_raster_crs(self._transformer, xs, ys)
+        if self._mode != 'sample' or self._interpolation != 'nearest':
+            rows, cols = xy_to_rowcol(self._raster.transform, xs, ys)
+            return interpolate(self._gather, rows, cols, self._interpolation, self._nodata, self._extent()).astype(xs.dtype)
         if self._band is None:
             return np.fromiter(self._raster.sample(zip(xs, ys)), xs.dtype, count=len(xs))
         return np.fromiter((i[self._band] for i in self._raster.sample(zip(xs, ys))), xs.dtype, count=len(xs))
 
+    def fingerprint(self):
+        """Return a string identifying the terrain this sampler returns, used
+        to key stored features. It covers the raster's path, size, modification
+        time and georeferencing, the band, crs and interpolation, and the window
+        kept in memory when mode is 'array'
+
+        :returns: the fingerprint of the sampler
+        :rtype: str
+        """
+        parts = [
+            self._raster.name, self._raster.width, self._raster.height,
+            list(self._raster.transform)[:6], str(self._raster.crs),
+            self._band_index, str(self._crs), self._interpolation,
+        ]
+        if os.path.exists(self._raster.name):
+            stat = os.stat(self._raster.name)
+            parts += [stat.st_size, stat.st_mtime_ns]
+        if self._mode == 'array':
+            parts += [self._window.col_off, self._window.row_off, self._window.width, self._window.height]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def cache_info(self):
+        """Report the tile cache statistics, only available when mode is 'tiled'
+
+        :returns: the hits, misses, and evictions of the tile cache, along with
+            its current and maximum size in bytes
+        :rtype: class: `iot_net_planner.geo.tile_cache.TileCacheInfo`
+        """
+        if self._mode != 'tiled':
+            raise ValueError("cache_info is only available when mode is 'tiled'")
+        return self._tiles.info()
+
+    def _gather(self, rows, cols):
+        # Look up integer raster rows and cols, the fill value outside the raster
+        if self._mode == 'array':
+            return gather(self._array, rows - self._window.row_off, cols - self._window.col_off, self._fill)
+        if self._mode == 'sample':
+            transform = self._raster.transform
+            xs = transform.a * (cols + 0.5) + transform.b * (rows + 0.5) + transform.c
+            ys = transform.d * (cols + 0.5) + transform.e * (rows + 0.5) + transform.f
+            return np.fromiter((i[0] for i in self._raster.sample(zip(xs, ys), indexes=self._band_index)), np.float64, count=len(xs))
+
+        values = np.full(len(rows), self._fill, dtype=self._raster.dtypes[self._band_index - 1])
+        inside = np.flatnonzero((rows >= 0) & (rows < self._raster.height) & (cols >= 0) & (cols < self._raster.width))
+        if len(inside) == 0:
+            return values
+        rows = rows[inside]
+        cols = cols[inside]
+
+        # Group the points by tile so each tile is looked up once per batch
+        tile_h, tile_w = self._tile_size
+        tile_ids = (rows // tile_h) * self._tile_cols + cols // tile_w
+        keys, inverse = np.unique(tile_ids, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        for key, group in zip(keys, groups):
+            tile = self._tiles.get(int(key))
+            row_off = (key // self._tile_cols) * tile_h
+            col_off = (key % self._tile_cols) * tile_w
+            values[inside[group]] = tile[rows[group] - row_off, cols[group] - col_off]
+        return values
+
+    def _extent(self):
+        # The (row_start, col_start, row_stop, col_stop) pixels _gather can return
+        if self._mode == 'array':
+            window = self._window
+            return window.row_off, window.col_off, window.row_off + window.height, window.col_off + window.width
+        return 0, 0, self._raster.height, self._raster.width
+
+    def _default_tile_size(self):
+        # Use the block shape of 2D-tiled rasters, otherwise about 256 x 256 aligned to the blocks
+        block_h, block_w = self._raster.block_shapes[self._band_index - 1]
+        if block_w < self._raster.width:
+            return block_h, block_w
+        return min(-(-256 // block_h) * block_h, self._raster.height), min(256, self._raster.width)
+
+    def _read_tile(self, key):
+        # Decode the tile with the given id from the raster
+        tile_h, tile_w = self._tile_size
+        row_off = (key // self._tile_cols) * tile_h
+        col_off = (key % self._tile_cols) * tile_w
+        window = Window(col_off, row_off, min(tile_w, self._raster.width - col_off), min(tile_h, self._raster.height - row_off))
+        return self._raster.read(self._band_index, window=window)
+
+    def _read_window(self, bounds):
+        # Read the window covering bounds (or the whole band) into memory
+        if bounds is None:
+            window = Window(0, 0, self._raster.width, self._raster.height)
+        else:
+            minx, miny, maxx, maxy = bounds
+            if self._transformer is not None:
+                minx, miny, maxx, maxy = self._transformer.transform_bounds(minx, miny, maxx, maxy)
+            rows, cols = xy_to_rowcol(self._raster.transform, np.array([minx, minx, maxx, maxx]), np.array([miny, maxy, miny, maxy]))
+            # Pad by a pixel so points on the edge of bounds are kept
+            row_start = max(0, int(np.floor(rows.min())) - 1)
+            col_start = max(0, int(np.floor(cols.min())) - 1)
+            row_stop = min(self._raster.height, int(np.ceil(rows.max())) + 1)
+            col_stop = min(self._raster.width, int(np.ceil(cols.max())) + 1)
+            window = Window(col_start, row_start, max(0, col_stop - col_start), max(0, row_stop - row_start))
+        self._window = window
+        self._array = self._raster.read(self._band_index, window=window)
+
     def clean_up(self):
         """Closes the raster file, should always be called after the sampler is no longer in use
         """
+        if self._mode == 'tiled':
+            self._tiles.clear()
         self._raster.close()
 
     def __enter__(self):
@@ -1,15 +1,51 @@
 """Provides a function for guessing some good potential gateway locations based on building corners
 """
 
-import osmnx as ox
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
+import hashlib
+import json
+import os.path
 # from scipy.cluster.vq import kmeans2
-from sklearn.cluster import MiniBatchKMeans
-from shapely.geometry import Point
 
-def generate_facs(area, n_facs=None, sampler=None):
+_BUILDING_TAGS = {'building': True}
+
+def _cached_buildings(geom, cache_dir):
+    # Query osm for the buildings in geom (in EPSG:4326), keyed on disk by the polygon and tags
+    key = hashlib.sha256(shapely.to_wkb(geom) + json.dumps(_BUILDING_TAGS, sort_keys=True).encode()).hexdigest()
+    path = None if cache_dir is None else os.path.join(cache_dir, f"{key}.parquet")
+    if path is not None and os.path.exists(path):
+        return gpd.read_parquet(path)
+
+    import osmnx as ox
+    buildings = ox.features.features_from_polygon(geom, _BUILDING_TAGS)
+    buildings = buildings.explode(index_parts=False)[['geometry']].reset_index(drop=True)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        buildings.to_parquet(path)
+    return buildings
+
+def _load_buildings(area, cache_dir=None, buildings_file=None):
+    # Get the buildings intersecting each area geometry in area's crs
+    all_buildings = []
+
+    if buildings_file is not None:
+        if buildings_file.endswith(".parquet"):
+            source = gpd.read_parquet(buildings_file)
+        else:
+            source = gpd.read_file(buildings_file, bbox=area)
+        source = source[['geometry']].explode(index_parts=False).to_crs(area.crs)
+        for geom in area.geometry:
+            all_buildings.append(source.iloc[source.sindex.query(geom, predicate='intersects')])
+    else:
+        for geom in area.to_crs("EPSG:4326").geometry:
+            all_buildings.append(_cached_buildings(geom, cache_dir).to_crs(area.crs))
+
+    return gpd.GeoDataFrame(pd.concat(all_buildings, ignore_index=True))
+
+def generate_facs(area, n_facs=None, sampler=None, cache_dir=None, buildings_file=None, min_separation=None):
     """Estimate potential gateway locations for an area. Estimated locations
     will be the corners of buildings.
 
@@ -23,44 +59,50 @@ def generate_facs(area, n_facs=None, sampler=None):
         the altitude column. Must be initialized with area's crs. If None,
         no altitude is given, defaults to None
     :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`, optional
+    :param cache_dir: a directory to cache building footprints queried from
+        OpenStreetMap in. Footprints are stored by a hash of the area polygon and
+        the query, so repeated runs over the same area skip the query. If None,
+        nothing is cached, defaults to None
+    :type cache_dir: str, optional
+    :param buildings_file: a path to a local file of building footprints, such as
+        an extracted GeoPackage or '.parquet' GeoParquet file, to use instead of
+        querying OpenStreetMap. Buildings in the area are found with a spatial index,
+        defaults to None
+    :type buildings_file: str, optional
+    :param min_separation: if not None, corners are thinned before clustering by
+        keeping one corner (the highest, if there are altitudes) in each grid cell
+        of this size in area's crs units. This removes near-duplicate corners of
+        dense areas, defaults to None
+    :type min_separation: float, optional
     """
-    all_buildings = []
+    buildings = _load_buildings(area, cache_dir, buildings_file)
 
-    # Query buildings and build a dataframe
-    for geom in area.to_crs("EPSG:4326").geometry:
-        buildings = ox.features.features_from_polygon(geom, {'building': True})
-        buildings = buildings.explode(index_parts=False).to_crs(area.crs)
-        all_buildings.append(buildings[['geometry']])
-
-    buildings = gpd.GeoDataFrame(pd.concat(all_buildings, ignore_index=True))
-    
-    buildings = buildings[buildings.geometry.apply(lambda geom: geom.geom_type).isin(['Point', 'Polygon'])]
+    buildings = buildings[buildings.geometry.geom_type.isin(['Point', 'Polygon'])]
+    geoms = np.asarray(buildings.geometry)
 
     # Sample at centroids to fill altitude
     if sampler is not None:
-        buildings['center'] = buildings.geometry.apply(lambda geom: geom if geom.geom_type == 'Point' else geom.centroid)
-        samples = sampler.batched_sample(buildings['center'].x, buildings['center'].y)
-        buildings['altitude'] = np.array(samples)
-    else:
-        buildings['altitude'] = None
+        centers = shapely.centroid(geoms)
+        altitudes = np.array(sampler.batched_sample(shapely.get_x(centers), shapely.get_y(centers)))
 
-    points_list = []
+    # Break buildings into corner points, keeping which building each came from
+    is_polygon = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+    geoms = np.where(is_polygon, shapely.get_exterior_ring(geoms), geoms)
+    coords, building = shapely.get_coordinates(geoms, return_index=True)
 
-    # Break buildings into corner points
-    for _, row in buildings.iterrows():
-        if row.geometry.geom_type == 'Point':
-            points_list.append({'geometry': row.geometry, 'altitude': row['altitude']})
-        elif row.geometry.geom_type == 'Polygon':
-            for point in row.geometry.exterior.coords:
-                points_list.append({'geometry': gpd.points_from_xy([point[0]], [point[1]])[0], 'altitude': row['altitude']})    
+    area_geom = shapely.union_all(np.asarray(area.geometry))
+    shapely.prepare(area_geom)
+    inside = shapely.contains_xy(area_geom, coords[:, 0], coords[:, 1])
+    coords = coords[inside]
 
-    buildings = gpd.GeoDataFrame(points_list, crs=buildings.crs)    
-    if sampler is None:
-        buildings.drop('altitude', axis=1, inplace=True)
-
-    buildings = buildings[buildings.geometry.apply(lambda point: any(area.contains(point)))]
+    buildings = gpd.GeoDataFrame(geometry=gpd.points_from_xy(coords[:, 0], coords[:, 1]), crs=buildings.crs, index=np.flatnonzero(inside))
+    if sampler is not None:
+        buildings['altitude'] = altitudes[building[inside]]
     buildings.reset_index(inplace=True)
 
+    if min_separation is not None:
+        buildings = _thin(buildings, min_separation)
+
     if n_facs is None or len(buildings) <= n_facs:
         return buildings
 
@@ -70,24 +112,33 @@ def generate_facs(area, n_facs=None, sampler=None):
     means_array[:, 1] = buildings.geometry.y
 
     # centroids, labels = kmeans2(means_array, n_facs, minit="++", missing="raise")        
+    from sklearn.cluster import MiniBatchKMeans
     kmeans = MiniBatchKMeans(n_clusters=n_facs, init='k-means++')
     kmeans.fit(means_array)
 
     centroids = kmeans.cluster_centers_
     labels = kmeans.labels_
 
-    indices = []
     if 'altitude' in buildings:
-        for label in np.unique(labels):
-            cluster = buildings[labels == label]
-
-            if not cluster.empty:
-                max_altitude_index = cluster['altitude'].idxmax()
-                indices.append(max_altitude_index)
+        # The highest corner of each cluster, sorting by label then descending altitude
+        order = np.lexsort((-buildings['altitude'].to_numpy(dtype=np.float64), labels))
+        _, first = np.unique(labels[order], return_index=True)
+        indices = order[first]
 
     else:
-        for centroid in centroids:
-            centroid = Point(centroid[0], centroid[1])
-            indices.append(buildings.geometry.distance(centroid).argmin())
+        # The corner nearest to each centroid in one batched query
+        from sklearn.neighbors import KDTree
+        indices = KDTree(means_array).query(centroids, k=1, return_distance=False)[:, 0]
         
     return buildings.iloc[indices]
+
+def _thin(buildings, min_separation):
+    # Keep one corner per min_separation sized grid cell, the highest if there are altitudes
+    coords = np.column_stack([buildings.geometry.x, buildings.geometry.y])
+    cells = np.floor(coords / min_separation).astype(np.int64)
+    if 'altitude' in buildings:
+        order = np.argsort(-buildings['altitude'].to_numpy(dtype=np.float64), kind='stable')
+    else:
+        order = np.arange(len(buildings))
+    _, first = np.unique(cells[order], axis=0, return_index=True)
+    return buildings.iloc[np.sort(order[first])].reset_index(drop=True)
@@ -0,0 +1,147 @@
+"""A preprocessed, memory-mappable DSM format and a sampler for it. Converting
+a DSM once removes raster decompression from sampling, and processes sampling
+the same file share the operating system's page cache.
+"""
+
+import hashlib
+import json
+import os.path
+
+import numpy as np
+import rasterio as rio
+from rasterio.transform import Affine
+from numpy.lib.format import open_memmap
+from rasterio.windows import Window
+
+from iot_net_planner.geo.sampler import LinkSampler
+from iot_net_planner.geo.raster_lookup import crs_transformer, to_raster_crs, xy_to_rowcol, gather, interpolate
+
+def _sidecar_path(array_path):
+    return os.path.splitext(array_path)[0] + ".json"
+
+def convert_dsm(raster_path, out_path, band=None):
+    """Convert a DSM into an uncompressed '.npy' array that can be memory-mapped
+    and a '.json' sidecar holding its affine transform, crs and nodata value.
+    The DSM is copied in strips so it never needs to fit in memory.
+
+    :param raster_path: a path to the DSM to convert
+    :type raster_path: str
+    :param out_path: the path to write the array to. The file should be a
+        '.npy' file, and this extension will be appended if it is not present.
+        The sidecar is written next to it with a '.json' extension
+    :type out_path: str
+    :param band: the 0-indexed DSM band to convert, can be None if only one band
+        is present, defaults to None
+    :type band: int, optional
+    :returns: the path of the written array
+    :rtype: str
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    out_path += (not ends_in(out_path, ".npy")) * ".npy"
+    band_index = 1 if band is None else band + 1
+
+    with rio.open(raster_path) as src:
+        out = open_memmap(out_path, mode='w+', dtype=src.dtypes[band_index - 1], shape=(src.height, src.width))
+        strip = src.block_shapes[band_index - 1][0]
+        for row in range(0, src.height, strip):
+            height = min(strip, src.height - row)
+            out[row:row + height] = src.read(band_index, window=Window(0, row, src.width, height))
+        out.flush()
+        del out
+
+        sidecar = {
+            'transform': list(src.transform)[:6],
+            'crs': src.crs.to_wkt(),
+            'nodata': src.nodata,
+        }
+
+    with open(_sidecar_path(out_path), 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, indent=4)
+
+    return out_path
+
+class MemmapSampler(LinkSampler):
+    """A link sampler that samples from a DSM converted with convert_dsm.
+    The array is memory-mapped and sampled with numpy indexing. Like DSMSampler
+    it should be cleaned up after use, or used with the ```with MemmapSampler(crs, path) as sampler```
+    syntax.
+
+    :param crs: the crs of the input points, should match the demand and facility crs.
+    :type crs: str
+    :param array_path: a path to the '.npy' file written by convert_dsm
+    :type array_path: str
+    :param interpolation: how values between pixel centers are found. One of 'nearest',
+        'bilinear', or 'bicubic', defaults to 'nearest'
+    :type interpolation: str, optional
+    """
+    def __init__(self, crs, array_path, interpolation='nearest'):
+        """Constructor method
+        """
+        if interpolation not in ('nearest', 'bilinear', 'bicubic'):
+            raise ValueError(f"Unknown interpolation '{interpolation}', expected 'nearest', 'bilinear', or 'bicubic'")
+        with open(_sidecar_path(array_path), encoding='utf-8') as f:
+            sidecar = json.load(f)
+        self._array = np.load(array_path, mmap_mode='r')
+        self._array_path = array_path
+        self._transform = Affine(*sidecar['transform'])
+        self._nodata = sidecar['nodata']
+        self._fill = 0 if self._nodata is None else self._nodata
+        self._crs = crs
+        self._interpolation = interpolation
+        self._transformer = crs_transformer(crs, sidecar['crs'])
+
+    def sample(self, x, y):
+        """Return the raster sample at x, y
+
+        :param x: the x-coordinate in the provided crs
+        :type x: float
+        :param y: the y-coordinate in the provided crs
+        :type y: float
+        :returns: the sample at (x, y)
+        :rtype: float
+        """
+        return self.batched_sample(np.atleast_1d(x), np.atleast_1d(y))[0]
+
+    def batched_sample(self, xs, ys):
+        """Return a numpy array of the samples at the points defined by xs and ys
+
+        :param xs: the x-coordinates in the provided crs
+        :type xs: np.ndarray
+        :param ys: the y-coordinates in the provided crs with len(ys) == len(xs)
+        :type ys: np.ndarray
+        :returns: the samples at the provided points
+        :rtype: np.ndarray
+        """
+        xs, ys = to_raster_crs(self._transformer, xs, ys)
+        rows, cols = xy_to_rowcol(self._transform, xs, ys)
+        lookup = lambda rows, cols: gather(self._array, rows, cols, self._fill)
+        extent = (0, 0) + self._array.shape
+        return np.asarray(interpolate(lookup, rows, cols, self._interpolation, self._nodata, extent), dtype=xs.dtype)
+
+    def fingerprint(self):
+        """Return a string identifying the terrain this sampler returns, used
+        to key stored features. It covers the array's path, size, modification
+        time and georeferencing, the crs and the interpolation
+
+        :returns: the fingerprint of the sampler
+        :rtype: str
+        """
+        stat = os.stat(self._array_path)
+        parts = [
+            os.path.abspath(self._array_path), stat.st_size, stat.st_mtime_ns,
+            list(self._transform)[:6], str(self._crs), self._interpolation,
+        ]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def clean_up(self):
+        """Releases the memory-mapped array, should always be called after the sampler is no longer in use
+        """
+        self._array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self.clean_up()
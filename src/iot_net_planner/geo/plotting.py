@@ -2,11 +2,7 @@
 """
 
 import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
-import contextily as ctx
-from matplotlib.colors import Normalize
-from matplotlib.cm import ScalarMappable
 from shapely.geometry import Polygon, Point
 
 def plot_fac_coverage(dems, facs, fac, contributions, save_to=None):
@@ -43,6 +39,11 @@ def plot_facs_coverage(dems, facs, built, contributions, save_to=None):
         defaults to None
     :type save_to: str, optional
     """
+    import matplotlib.pyplot as plt
+    import contextily as ctx
+    from matplotlib.colors import Normalize
+    from matplotlib.cm import ScalarMappable
+
     dems = dems.to_crs(epsg=3857)
     facs = facs.to_crs(epsg=3857)
     contributions = contributions.clip(0.0, 1.0)
@@ -85,6 +86,9 @@ def plot_demands(dems, save_to=None):
         defaults to None
     :type save_to: str, optional
     """
+    import matplotlib.pyplot as plt
+    import contextily as ctx
+
     dems = dems.to_crs(epsg=3857)
     fig, ax = plt.subplots(1, 1, figsize=(10, 10))
 
@@ -109,6 +113,11 @@ def plot_facs(facs, save_to=None):
     plot_demands(facs, save_to)
 
 def plot_facs_coverage_hex(dems, facs, built, contributions, grid_granularity=300/0.3048):
+    import matplotlib.pyplot as plt
+    import contextily as ctx
+    from matplotlib.colors import Normalize
+    from matplotlib.cm import ScalarMappable
+
     dems = dems.to_crs(dems.estimate_utm_crs())
     facs = facs.to_crs(epsg=3857)
     
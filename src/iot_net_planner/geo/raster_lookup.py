@@ -0,0 +1,158 @@
+"""Vectorized helpers for looking up raster values held in numpy arrays
+"""
+
+import numpy as np
+from pyproj import CRS, Transformer
+
+def crs_transformer(crs, raster_crs):
+    """Build a transformer from crs to raster_crs once so it can be reused
+    for every batch
+
+    :param crs: the crs of the input points
+    :type crs: str
+    :param raster_crs: the crs of the raster
+    :type raster_crs: str
+    :returns: an always_xy transformer, or None if the two crs are equal and
+        no reprojection is needed
+    :rtype: pyproj.Transformer
+    """
+    if CRS.from_user_input(crs) == CRS.from_user_input(raster_crs):
+        return None
+    return Transformer.from_crs(crs, raster_crs, always_xy=True)
+
+def to_raster_crs(transformer, xs, ys):
+    """Reproject coordinate arrays with a transformer from crs_transformer
+
+    :param transformer: the transformer to use, None means no reprojection
+    :type transformer: pyproj.Transformer
+    :param xs: the x-coordinates to reproject
+    :type xs: np.ndarray
+    :param ys: the y-coordinates to reproject with len(ys) == len(xs)
+    :type ys: np.ndarray
+    :returns: the reprojected x and y coordinates as float arrays
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if transformer is None:
+        return xs, ys
+    return transformer.transform(xs, ys)
+
+def xy_to_rowcol(transform, xs, ys):
+    """Convert coordinates to fractional pixel rows and columns
+
+    :param transform: the affine transform mapping (col, row) to (x, y)
+    :type transform: affine.Affine
+    :param xs: the x-coordinates in the raster's crs
+    :type xs: np.ndarray
+    :param ys: the y-coordinates in the raster's crs with len(ys) == len(xs)
+    :type ys: np.ndarray
+    :returns: the fractional rows and columns of each point. Flooring them
+        gives the index of the pixel containing the point
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    inv = ~transform
+    cols = inv.a * xs + inv.b * ys + inv.c
+    rows = inv.d * xs + inv.e * ys + inv.f
+    return rows, cols
+
+def gather(array, rows, cols, fill):
+    """Return array[rows, cols] with fill for indices outside of array
+
+    :param array: a 2D array of raster values
+    :type array: np.ndarray
+    :param rows: the integer row indices
+    :type rows: np.ndarray
+    :param cols: the integer column indices with len(cols) == len(rows)
+    :type cols: np.ndarray
+    :param fill: the value to give points outside of array
+    :type fill: float
+    :returns: the values at each (row, col)
+    :rtype: np.ndarray
+    """
+    inside = (rows >= 0) & (rows < array.shape[0]) & (cols >= 0) & (cols < array.shape[1])
+    if np.all(inside):
+        return array[rows, cols]
+    values = np.full(len(rows), fill, dtype=array.dtype)
+    values[inside] = array[rows[inside], cols[inside]]
+    return values
+
+def _cubic_weights(t):
+    # Keys cubic convolution weights (a = -0.5) for the offsets -1, 0, 1, 2
+    return np.stack([
+        ((-0.5 * t + 1.0) * t - 0.5) * t,
+        (1.5 * t - 2.5) * t * t + 1.0,
+        ((-1.5 * t + 2.0) * t + 0.5) * t,
+        (0.5 * t - 0.5) * t * t,
+    ])
+
+def _is_nodata(values, nodata):
+    # Which values are nodata, none of them if the raster has no nodata value
+    if nodata is None:
+        return np.zeros(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return np.isnan(values)
+    return values == nodata
+
+def interpolate(lookup, rows, cols, method, nodata, extent):
+    """Interpolate raster values at fractional pixel positions. All of the
+    neighboring pixels are looked up in one call. Points with a nodata pixel
+    or a pixel outside of extent among their neighbors, such as those on the
+    edge of the raster, fall back to the nearest pixel.
+
+    :param lookup: a function taking integer row and column arrays and returning
+        the raster values there, with a fill value outside of extent
+    :type lookup: Callable
+    :param rows: the fractional rows from xy_to_rowcol
+    :type rows: np.ndarray
+    :param cols: the fractional columns from xy_to_rowcol with len(cols) == len(rows)
+    :type cols: np.ndarray
+    :param method: one of 'nearest', 'bilinear', or 'bicubic'
+    :type method: str
+    :param nodata: the raster's nodata value, None if it has none
+    :type nodata: float
+    :param extent: a (row_start, col_start, row_stop, col_stop) tuple of the
+        pixels lookup can return
+    :type extent: tuple
+    :returns: the interpolated values
+    :rtype: np.ndarray
+    """
+    if method == 'nearest':
+        return lookup(np.floor(rows).astype(np.int64), np.floor(cols).astype(np.int64))
+
+    # Pixel centers sit at half-integer positions
+    rows = rows - 0.5
+    cols = cols - 0.5
+    row_start = np.floor(rows)
+    col_start = np.floor(cols)
+    row_t = rows - row_start
+    col_t = cols - col_start
+
+    if method == 'bilinear':
+        offsets = np.arange(2)
+        row_weights = np.stack([1.0 - row_t, row_t])
+        col_weights = np.stack([1.0 - col_t, col_t])
+    elif method == 'bicubic':
+        offsets = np.arange(-1, 3)
+        row_weights = _cubic_weights(row_t)
+        col_weights = _cubic_weights(col_t)
+    else:
+        raise ValueError(f"Unknown interpolation '{method}', expected 'nearest', 'bilinear', or 'bicubic'")
+
+    k = len(offsets)
+    row_start = row_start.astype(np.int64)
+    col_start = col_start.astype(np.int64)
+    neighbor_rows = (row_start + offsets[:, None, None]).repeat(k, axis=1)
+    neighbor_cols = (col_start + offsets[None, :, None]).repeat(k, axis=0)
+    values = lookup(neighbor_rows.ravel(), neighbor_cols.ravel()).reshape((k, k, len(rows)))
+
+    result = np.einsum('in,jn,ijn->n', row_weights, col_weights, values.astype(np.float64))
+
+    row_start, col_start, row_stop, col_stop = extent
+    outside = (neighbor_rows < row_start) | (neighbor_rows >= row_stop) | (neighbor_cols < col_start) | (neighbor_cols >= col_stop)
+    invalid = np.any(outside | _is_nodata(values, nodata), axis=(0, 1))
+    if np.any(invalid):
+        nearest_rows = np.floor(rows[invalid] + 0.5).astype(np.int64)
+        nearest_cols = np.floor(cols[invalid] + 0.5).astype(np.int64)
+        result[invalid] = lookup(nearest_rows, nearest_cols)
+    return result
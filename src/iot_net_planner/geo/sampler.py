@@ -33,3 +33,13 @@ class LinkSampler(ABC):
         :rtype: np.ndarray
         """
         return xs + ys
+
+    def fingerprint(self):
+        """Return a string identifying the terrain this sampler returns, used
+        to key stored features. Samplers with equal fingerprints return the same
+        samples. Samplers that cannot identify their terrain return None
+
+        :returns: the fingerprint of the sampler, or None
+        :rtype: str
+        """
+        return None
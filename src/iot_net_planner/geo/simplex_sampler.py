@@ -2,11 +2,99 @@
 """
 
 from iot_net_planner.geo.sampler import LinkSampler
-from opensimplex import seed, noise2
-from numpy import array
+from opensimplex import OpenSimplex
+import numpy as np
+
+# Constants of the 2D OpenSimplex noise used by opensimplex
+_STRETCH = -0.211324865405187
+_SQUISH = 0.366025403784439
+_NORM = 47
+_GRADIENTS = np.array([
+    5, 2, 2, 5,
+    -5, 2, -2, 5,
+    5, -2, 2, -5,
+    -5, -2, -2, -5,
+], dtype=np.float64)
+
+def _permutation(random_seed):
+    # The same permutation opensimplex builds from a seed, using wrapping 64-bit arithmetic
+    def step(s):
+        s = (s * 6364136223846793005 + 1442695040888963407) & 0xFFFFFFFFFFFFFFFF
+        return s - (1 << 64) if s >= (1 << 63) else s
+
+    perm = np.zeros(256, dtype=np.int64)
+    source = list(range(256))
+    s = random_seed
+    for _ in range(3):
+        s = step(s)
+    for i in range(255, -1, -1):
+        s = step(s)
+        r = int((s + 31) % (i + 1))
+        perm[i] = source[r]
+        source[r] = source[i]
+    return perm
+
+def _contribution(perm, xsb, ysb, dx, dy):
+    # The attenuated gradient contribution of the lattice vertex (xsb, ysb)
+    index = perm[(perm[xsb & 0xFF] + ysb) & 0xFF] & 0x0E
+    extrapolation = _GRADIENTS[index] * dx + _GRADIENTS[index + 1] * dy
+    attn = 2 - dx * dx - dy * dy
+    attn = np.where(attn > 0, attn, 0)
+    attn *= attn
+    return attn * attn * extrapolation
+
+def _noise2(perm, x, y):
+    # A vectorized port of opensimplex's 2D noise, matching it for every point
+    stretch_offset = (x + y) * _STRETCH
+    xs = x + stretch_offset
+    ys = y + stretch_offset
+    xsb = np.floor(xs)
+    ysb = np.floor(ys)
+    squish_offset = (xsb + ysb) * _SQUISH
+    dx0 = x - (xsb + squish_offset)
+    dy0 = y - (ysb + squish_offset)
+    xins = xs - xsb
+    yins = ys - ysb
+    in_sum = xins + yins
+    xsb = xsb.astype(np.int64)
+    ysb = ysb.astype(np.int64)
+
+    value = _contribution(perm, xsb + 1, ysb, dx0 - 1 - _SQUISH, dy0 - 0 - _SQUISH)
+    value += _contribution(perm, xsb, ysb + 1, dx0 - 0 - _SQUISH, dy0 - 1 - _SQUISH)
+
+    # Pick the extra vertex depending on the region of the rhombus the point is in
+    lower = in_sum <= 1
+    x_larger = xins > yins
+    lower_near = lower & (((1 - in_sum) > xins) | ((1 - in_sum) > yins))
+    upper_near = (~lower) & (((2 - in_sum) < xins) | ((2 - in_sum) < yins))
+    cases = [
+        lower_near & x_larger,
+        lower_near & ~x_larger,
+        lower & ~lower_near,
+        upper_near & x_larger,
+        upper_near & ~x_larger,
+    ]
+    xsv_ext = np.select(cases, [xsb + 1, xsb - 1, xsb + 1, xsb + 2, xsb], xsb)
+    ysv_ext = np.select(cases, [ysb - 1, ysb + 1, ysb + 1, ysb, ysb + 2], ysb)
+    dx_ext = np.select(cases, [dx0 - 1, dx0 + 1, dx0 - 1 - 2 * _SQUISH, dx0 - 2 - 2 * _SQUISH, dx0 + 0 - 2 * _SQUISH], dx0)
+    dy_ext = np.select(cases, [dy0 + 1, dy0 - 1, dy0 - 1 - 2 * _SQUISH, dy0 + 0 - 2 * _SQUISH, dy0 - 2 - 2 * _SQUISH], dy0)
+
+    # Points in the upper triangle use the (1, 1) vertex instead of (0, 0)
+    upper = ~lower
+    xsb = xsb + upper
+    ysb = ysb + upper
+    dx0 = np.where(upper, dx0 - 1 - 2 * _SQUISH, dx0)
+    dy0 = np.where(upper, dy0 - 1 - 2 * _SQUISH, dy0)
+
+    value += _contribution(perm, xsb, ysb, dx0, dy0)
+    value += _contribution(perm, xsv_ext, ysv_ext, dx_ext, dy_ext)
+
+    return value / _NORM
 
 class SimplexSampler(LinkSampler):
-    """A sampler that samples from a random texture to simulate a random terrain
+    """A sampler that samples from a random texture to simulate a random terrain.
+    Each sampler holds its own noise state, so samplers with different seeds
+    can be used at the same time.
 
     :param random_seed: the seed for the random texture
     :type random_seed: int
@@ -18,7 +106,9 @@ class SimplexSampler(LinkSampler):
         """Constructor method
         """
         self.scale = scale
-        seed(random_seed)
+        self._seed = random_seed
+        self._noise = OpenSimplex(random_seed)
+        self._perm = _permutation(random_seed)
 
     def sample(self, x, y):
         """Return the raster sample at x, y
@@ -30,9 +120,18 @@ class SimplexSampler(LinkSampler):
         :returns: the sample at (x, y)
         :rtype: float
         """
-        value = noise2(self.scale * x, self.scale * y)
+        value = self._noise.noise2(self.scale * x, self.scale * y)
         return value
 
+    def fingerprint(self):
+        """Return a string identifying the terrain this sampler returns, used
+        to key stored features
+
+        :returns: the fingerprint of the sampler
+        :rtype: str
+        """
+        return f"simplex-{self._seed}-{float(self.scale)!r}"
+
     def batched_sample(self, xs, ys):
         """Return a numpy array of the samples at the points defined by xs and ys
 
@@ -43,4 +142,6 @@ class SimplexSampler(LinkSampler):
         :returns: the samples at the provided points
         :rtype: np.ndarray
         """
-        return array([self.sample(x, y) for x, y in zip(xs, ys)])
+        xs = self.scale * np.asarray(xs, dtype=np.float64)
+        ys = self.scale * np.asarray(ys, dtype=np.float64)
+        return _noise2(self._perm, xs, ys)
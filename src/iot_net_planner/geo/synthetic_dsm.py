@@ -0,0 +1,83 @@
+"""A tool for rendering procedural terrain into a DSM raster. The rendered raster
+can be used with DSMSampler or MemmapSampler so benchmarks exercise the same
+code path as real DSMs without shipping large GeoTIFFs.
+"""
+
+from uuid import uuid4
+
+import numpy as np
+import rasterio as rio
+from rasterio.shutil import delete
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+def render_dsm(sampler, bounds, resolution, crs, out_path=None, height_scale=1.0, offset=0.0, block_size=256):
+    """Render the terrain of a sampler into a single band float32 GeoTIFF
+    with a north-up affine transform. Pixels are sampled at their centers.
+
+    :param sampler: the sampler to render, for example a SimplexSampler. It is
+        sampled with coordinates in crs
+    :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`
+    :param bounds: a (minx, miny, maxx, maxy) tuple in crs of the area to render
+    :type bounds: tuple
+    :param resolution: the width and height of a pixel in crs units
+    :type resolution: float
+    :param crs: the crs of the raster
+    :type crs: str
+    :param out_path: the path to write the GeoTIFF to. If None, the raster is
+        written to GDAL's in-memory filesystem and holds its memory until it is
+        freed with remove_dsm, defaults to None
+    :type out_path: str, optional
+    :param height_scale: each pixel is offset + height_scale * sample, which turns
+        noise in [-1, 1] into heights, defaults to 1.0
+    :type height_scale: float, optional
+    :param offset: see height_scale, defaults to 0.0
+    :type offset: float, optional
+    :param block_size: the size of the internal raster tiles, also the number of
+        rows rendered at a time, defaults to 256
+    :type block_size: int, optional
+    :returns: the path of the raster, which can be passed to DSMSampler
+    :rtype: str
+    """
+    if out_path is None:
+        out_path = f"/vsimem/synthetic_dsm_{uuid4().hex}.tif"
+
+    minx, miny, maxx, maxy = bounds
+    width = max(1, int(np.ceil((maxx - minx) / resolution)))
+    height = max(1, int(np.ceil((maxy - miny) / resolution)))
+    transform = from_origin(minx, maxy, resolution, resolution)
+
+    profile = {
+        'driver': 'GTiff',
+        'width': width,
+        'height': height,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': crs,
+        'transform': transform,
+        'nodata': -9999.0,
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+    }
+
+    x_centers = minx + (np.arange(width) + 0.5) * resolution
+    with rio.open(out_path, 'w', **profile) as dst:
+        for row in range(0, height, block_size):
+            rows = min(block_size, height - row)
+            y_centers = maxy - (np.arange(row, row + rows) + 0.5) * resolution
+            xs, ys = np.meshgrid(x_centers, y_centers)
+            heights = offset + height_scale * sampler.batched_sample(xs.ravel(), ys.ravel())
+            dst.write(heights.reshape((rows, width)).astype(np.float32), 1, window=Window(0, row, width, rows))
+
+    return out_path
+
+def remove_dsm(path):
+    """Delete a raster written by render_dsm, freeing its memory if it was
+    written to GDAL's in-memory filesystem. Any sampler using it should be
+    cleaned up first
+
+    :param path: the path returned by render_dsm
+    :type path: str
+    """
+    delete(path)
@@ -0,0 +1,70 @@
+"""A least recently used cache of decoded raster tiles
+"""
+
+from collections import OrderedDict, namedtuple
+
+TileCacheInfo = namedtuple('TileCacheInfo', ['hits', 'misses', 'evictions', 'currsize', 'maxsize'])
+
+class TileCache():
+    """An LRU cache of raster tiles bounded by the number of bytes held.
+    The most recently used tile is always kept, even if it alone is larger
+    than the budget.
+
+    :param read_tile: a function taking a tile key and returning the
+        decoded tile as a numpy array
+    :type read_tile: Callable
+    :param max_bytes: the memory budget of the cache in bytes
+    :type max_bytes: int
+    """
+    def __init__(self, read_tile, max_bytes):
+        """Constructor method
+        """
+        self._read_tile = read_tile
+        self._max_bytes = max_bytes
+        self._tiles = OrderedDict()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        """Return the tile for key, reading it on a miss
+
+        :param key: the key identifying the tile
+        :type key: hashable
+        :returns: the decoded tile
+        :rtype: np.ndarray
+        """
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._hits += 1
+            self._tiles.move_to_end(key)
+            return tile
+
+        self._misses += 1
+        tile = self._read_tile(key)
+        self._tiles[key] = tile
+        self._nbytes += tile.nbytes
+
+        # Evict least recently used tiles until back under budget
+        while self._nbytes > self._max_bytes and len(self._tiles) > 1:
+            _, evicted = self._tiles.popitem(last=False)
+            self._nbytes -= evicted.nbytes
+            self._evictions += 1
+
+        return tile
+
+    def info(self):
+        """Report the cache statistics
+
+        :returns: the hits, misses, and evictions so far, along with
+            the current and maximum size of the cache in bytes
+        :rtype: TileCacheInfo
+        """
+        return TileCacheInfo(self._hits, self._misses, self._evictions, self._nbytes, self._max_bytes)
+
+    def clear(self):
+        """Remove all tiles from the cache, statistics are kept
+        """
+        self._tiles.clear()
+        self._nbytes = 0
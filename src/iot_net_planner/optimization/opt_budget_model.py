@@ -2,7 +2,6 @@
 """
 from abc import ABC, abstractmethod
 
-from sklearn.neighbors import NearestNeighbors
 import numpy as np
 
 class OPTBudgetModel(ABC):
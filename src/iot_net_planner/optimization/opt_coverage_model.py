@@ -2,7 +2,6 @@
 """
 from abc import ABC, abstractmethod
 
-from sklearn.neighbors import NearestNeighbors
 import numpy as np
 
 class OPTCoverageModel(ABC):
@@ -19,6 +18,7 @@ class OPTCoverageModel(ABC):
         false_indices = facs.index[false_mask].tolist()
         false_coords = np.array(list(zip(facs.geometry.x[false_mask], facs.geometry.y[false_mask])))
 
+        from sklearn.neighbors import NearestNeighbors
         nbrs = NearestNeighbors(n_neighbors=k)
         nbrs.fit(false_coords)
 
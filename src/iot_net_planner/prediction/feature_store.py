@@ -0,0 +1,182 @@
+"""An on-disk store of line of sight features, so models can be swapped or
+retrained without sampling the terrain again
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+def _point_digests(points):
+    # A digest of each point's x, y and altitude
+    altitudes = np.zeros(len(points)) if points.altitudes is None else points.altitudes
+    rows = np.ascontiguousarray(np.column_stack([points.xs, points.ys, altitudes]))
+    return [hashlib.sha256(row.tobytes()).hexdigest() for row in rows]
+
+class FeatureStore():
+    """Wraps an ML253FeaturesInput and stores the inputs it generates on disk.
+    Inputs are kept in a directory keyed by the demand points, the sampler's
+    fingerprint, ncols and dtype. Each facility is one column of the link matrix
+    and is stored as its own '.npy' file of shape (len(dems), n_inputs) keyed
+    by the facility's location and altitude, along with a mask of the demand
+    points already stored. Requests read only the demand points they ask for
+    and only sample the terrain for those that are missing, so a store can be
+    filled a piece at a time and shared by every model using the same terrain.
+
+    :param input_gen: the input generator to store the inputs of
+    :type input_gen: class: `iot_net_planner.prediction.ml_253_input.ML253FeaturesInput`
+    :param store_dir: the directory to keep the stores in, created if needed
+    :type store_dir: str
+    :param fingerprint: a string identifying the terrain. If None, the sampler's
+        fingerprint is used, defaults to None
+    :type fingerprint: str, optional
+    :param chunk_size: the most demand points to read or generate at once,
+        defaults to 4096
+    :type chunk_size: int, optional
+    """
+    def __init__(self, input_gen, store_dir, fingerprint=None, chunk_size=4096):
+        """Constructor method
+        """
+        if fingerprint is None:
+            fingerprint = input_gen._sampler.fingerprint()
+        if fingerprint is None:
+            raise ValueError("The sampler has no fingerprint, pass one to the FeatureStore")
+
+        self._input_gen = input_gen
+        self._chunk_size = chunk_size
+        self._n_dems = len(input_gen._dem_points)
+        self._fac_digests = _point_digests(input_gen._fac_points)
+        self._all_dems = np.full(self._n_dems, True)
+
+        key = {
+            'dems': hashlib.sha256("".join(_point_digests(input_gen._dem_points)).encode()).hexdigest(),
+            'fingerprint': fingerprint,
+            'ncols': input_gen.n_inputs - 3,
+            'dtype': input_gen.dtype.name,
+        }
+        self._dir = os.path.join(store_dir, hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:32])
+        os.makedirs(self._dir, exist_ok=True)
+        key_path = os.path.join(self._dir, "key.json")
+        if not os.path.exists(key_path):
+            with open(key_path, 'w', encoding='utf-8') as f:
+                json.dump(key, f, indent=4)
+
+    @property
+    def dtype(self):
+        """The float type of the stored inputs
+
+        :return: the dtype of each input matrix
+        :rtype: np.dtype
+        """
+        return self._input_gen.dtype
+
+    @property
+    def n_inputs(self):
+        """The number of inputs per link
+
+        :return: the number of columns of each input matrix
+        :rtype: int
+        """
+        return self._input_gen.n_inputs
+
+    def get_input(self, fac, dems=None):
+        """Get the input from fac to dems, includes the constant
+
+        :param fac: the facility to get input from
+        :type fac: int
+        :param dems: a boolean numpy array of the demand points to get.
+            Will get the inputs to each demand point where dems[i] is True.
+            If None then get the input to all demand points, defaults to None
+        :type dems: np.ndarray
+        :returns: a 2D numpy matrix of the input floats with the first dimension being
+            the demand points, the second being the inputs.
+        :rtype: np.ndarray
+        """
+        blocks = list(self.iter_input(fac, dems))
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks)
+
+    def iter_input(self, fac, dems=None):
+        """Generate the input from fac to dems in blocks of at most chunk_size
+        demand points, includes the constant. Inputs that are not stored yet are
+        generated and stored first
+
+        :param fac: the facility to get input from
+        :type fac: int
+        :param dems: a boolean numpy array of the demand points to get.
+            Will get the inputs to each demand point where dems[i] is True.
+            If None then get the input to all demand points, defaults to None
+        :type dems: np.ndarray
+        :returns: a generator of 2D numpy matrices of the input floats with the first
+            dimension being the demand points, the second being the inputs.
+        :rtype: Iterator[np.ndarray]
+        """
+        if dems is None:
+            dems = self._all_dems
+        X, stored = self._open(fac)
+
+        missing = dems & ~stored
+        if missing.any():
+            self._fill(fac, X, stored, missing)
+
+        dem_idx = np.flatnonzero(dems)
+        for start in range(0, max(1, len(dem_idx)), self._chunk_size):
+            yield X[dem_idx[start:start + self._chunk_size]]
+
+    def get_link_inputs(self, facs, dems):
+        """Get the inputs for many (facility, demand point) links, see
+        ML253FeaturesInput.get_link_inputs. Links are not stored
+
+        :param facs: an integer numpy array of the facility end of each link
+        :type facs: np.ndarray
+        :param dems: an integer numpy array of the demand point end of each
+            link with len(dems) == len(facs)
+        :type dems: np.ndarray
+        :returns: a 2D numpy matrix of the input floats with the first dimension being
+            the links, the second being the inputs.
+        :rtype: np.ndarray
+        """
+        return self._input_gen.get_link_inputs(facs, dems)
+
+    def stored(self, fac):
+        """Which demand points have stored inputs from fac
+
+        :param fac: the facility to check
+        :type fac: int
+        :return: a boolean numpy array with stored[i] True if the input
+            to demand point i is stored
+        :rtype: np.ndarray
+        """
+        path = self._path(fac)
+        if not os.path.exists(path + ".stored.npy"):
+            return np.full(self._n_dems, False)
+        return np.load(path + ".stored.npy")
+
+    def _path(self, fac):
+        return os.path.join(self._dir, self._fac_digests[fac])
+
+    def _open(self, fac):
+        # Memory-map the facility's inputs and stored mask, creating them if needed
+        path = self._path(fac)
+        if not os.path.exists(path + ".stored.npy"):
+            X = open_memmap(path + ".npy", mode='w+', dtype=self.dtype, shape=(self._n_dems, self.n_inputs))
+            del X
+            stored = open_memmap(path + ".stored.npy", mode='w+', dtype=bool, shape=(self._n_dems,))
+            stored.flush()
+            del stored
+        return open_memmap(path + ".npy", mode='r+'), open_memmap(path + ".stored.npy", mode='r+')
+
+    def _fill(self, fac, X, stored, missing):
+        # Generate the missing inputs, marking them stored only once they are written
+        missing_idx = np.flatnonzero(missing)
+        for start in range(0, len(missing_idx), self._chunk_size):
+            block = missing_idx[start:start + self._chunk_size]
+            mask = np.full(self._n_dems, False)
+            mask[block] = True
+            X[block] = self._input_gen.get_input(fac, mask)
+            X.flush()
+            stored[block] = True
+            stored.flush()
@@ -2,13 +2,10 @@
 """
 from iot_net_planner.prediction.prr_model import PRRModel
 from iot_net_planner.prediction.ml_253_input import ML253FeaturesInput
+from iot_net_planner.prediction.feature_store import FeatureStore
 
 import numpy as np
-from statsmodels.iolib.smpickle import load_pickle as load_model
-from sklearn.preprocessing import StandardScaler
-from skl2onnx import to_onnx
 from onnxruntime import InferenceSession
-import statsmodels.api as sm
 
 class LRModel():
     """A prediction model using logistic regression
@@ -19,12 +16,16 @@ class LRModel():
         scaler .onnx file
     :type sc_file: str
     """
-    def __init__(self, path, sc):
+    def __init__(self, path, sc_file):
+        from statsmodels.iolib.smpickle import load_pickle as load_model
+
         self.model = load_model(path)
         with open(sc_file, "rb") as f:
             onx = f.read()
         standard_scalar = InferenceSession(onx)
         self._sc = standard_scalar
+        # Inputs are cast to the float type the scaler was exported with
+        self._sc_dtype = np.float32 if self._sc.get_inputs()[0].type == 'tensor(float)' else np.float64
 
     def forward(self, X):
         """Run the model on input X
@@ -34,7 +35,7 @@ class LRModel():
         :return: an n dimensional numpy array of predictions
         :rtype: np.ndarray
         """
-        X = self._sc.run(None, {"X": X})[0]
+        X = self._sc.run(None, {"X": np.asarray(X, dtype=self._sc_dtype)})[0]
         return self.model.predict(X)
 
 class LR253Features(PRRModel):
@@ -53,9 +54,22 @@ class LR253Features(PRRModel):
     :param ncols: the number of samples to use. The total number of
         inputs will be ncols + 3, defaults to 250
     :type ncols: int, optional
+    :param chunk_size: the most demand points to compute prrs for at once.
+        Keeps peak memory flat no matter how many demand points there are.
+        If None, all demand points are done at once, defaults to None
+    :type chunk_size: int, optional
+    :param dtype: the float type of the generated inputs. Use np.float32 with a
+        scaler exported for float32 inputs to avoid any conversion, defaults to np.float64
+    :type dtype: np.dtype, optional
+    :param store_dir: if not None, the generated inputs are kept in a FeatureStore
+        in this directory and reused by later runs on the same terrain, even with
+        a different model, defaults to None
+    :type store_dir: str, optional
     """
-    def __init__(self, dems, facs, sampler, model_path, sc_path, ncols=250):
-        self._input_gen = ML253FeaturesInput(dems, facs, sampler, ncols)
+    def __init__(self, dems, facs, sampler, model_path, sc_path, ncols=250, chunk_size=None, dtype=np.float64, store_dir=None):
+        self._input_gen = ML253FeaturesInput(dems, facs, sampler, ncols, chunk_size, dtype)
+        if store_dir is not None:
+            self._input_gen = FeatureStore(self._input_gen, store_dir, chunk_size=chunk_size or 4096)
         self._dems = dems
         self._facs = facs
         self._sampler = sampler
@@ -95,7 +109,10 @@ class LR253Features(PRRModel):
             each of the demand points where dems[i]
         :rtype: np.ndarray
         """
-        return self._model.forward(self._input_gen.get_input(fac, dems))
+        prrs = [self._model.forward(X) for X in self._input_gen.iter_input(fac, dems)]
+        if len(prrs) == 1:
+            return prrs[0]
+        return np.concatenate(prrs)
 
     def get_prr_ub(self, fac, dems=None):
         """Get an upper bound on prrs between fac and the self.dems[dems]  
@@ -131,7 +148,7 @@ class LR253Features(PRRModel):
         """
         return self.get_prr(fac, dems)
 
-def train_lr_253_model(X_train, y_train, sc_out, lr_out, logging=False):
+def train_lr_253_model(X_train, y_train, sc_out, lr_out, logging=False, dtype=np.float64):
     """Train a logistic regression model on data X and y. 
     Generates a standard scaler (sc) model and a logistic 
     regression model. Both of these models need to be used
@@ -153,7 +170,14 @@ def train_lr_253_model(X_train, y_train, sc_out, lr_out, logging=False):
     :param num_round: int for how many training rounds to perform,
         defaults to 1000
     :type num_round: int, optional
+    :param dtype: the float type the exported scaler takes as input,
+        defaults to np.float64
+    :type dtype: np.dtype, optional
     """
+    import statsmodels.api as sm
+    from sklearn.preprocessing import StandardScaler
+    from skl2onnx import to_onnx
+
     def ends_in(s, ending):
         return s[-1*len(ending):] == ending
 
@@ -162,7 +186,7 @@ def train_lr_253_model(X_train, y_train, sc_out, lr_out, logging=False):
 
     sc = StandardScaler()
     X_train = sc.fit_transform(X_train)
-    onx = to_onnx(sc, X_train[:1].astype(np.double))
+    onx = to_onnx(sc, X_train[:1].astype(dtype))
     if sc_out != ".onnx":
         with open(sc_out, "wb") as f:
             f.write(onx.SerializeToString())
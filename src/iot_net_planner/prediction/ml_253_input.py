@@ -2,11 +2,63 @@
 The input is 250 line segment samples, the log-distance,
 the log of the absolute altitude difference, and a constant
 """
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import statsmodels.api as sm
+from numpy.lib.format import open_memmap
 import geopandas as gpd
 from shapely.geometry import Point
 
+from iot_net_planner.prediction.point_store import PointStore
+
+def link_features(sampler, fac_xy, fac_alts, dem_xy, dem_alts, ncols=250, dtype=np.float64):
+    """Compute the 253 feature input for many links at once from their raw
+    endpoint coordinates, includes the constant. The line of sight samples
+    for every link are taken in a single sampler call.
+
+    :param sampler: the sampler to take line of sight samples from
+    :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`
+    :param fac_xy: an n by 2 array of the facility end of each link, or a
+        single (x, y) pair shared by all links
+    :type fac_xy: np.ndarray
+    :param fac_alts: the n facility altitudes, or a single shared altitude
+    :type fac_alts: np.ndarray
+    :param dem_xy: an n by 2 array of the demand end of each link
+    :type dem_xy: np.ndarray
+    :param dem_alts: the n demand altitudes
+    :type dem_alts: np.ndarray
+    :param ncols: the number of line of sight samples, defaults to 250
+    :type ncols: int, optional
+    :param dtype: the float type of the altitude profiles and the returned inputs.
+        Coordinates stay float64 so sample locations keep their precision,
+        defaults to np.float64
+    :type dtype: np.dtype, optional
+    :returns: a 2D numpy matrix of the input floats with the first dimension being
+        the links, the second being the ncols + 3 inputs.
+    :rtype: np.ndarray
+    """
+    dem_xy = np.asarray(dem_xy, dtype=np.float64).reshape((-1, 2))
+    dem_alts = np.asarray(dem_alts, dtype=np.float64)
+    n = len(dem_xy)
+    fac_xy = np.broadcast_to(np.asarray(fac_xy, dtype=np.float64), (n, 2))
+    fac_alts = np.broadcast_to(np.asarray(fac_alts, dtype=np.float64), (n,))
+
+    # Line segments run from the demand point to the facility
+    segments = np.linspace(dem_xy, fac_xy, ncols, axis=1)
+    altitudes = np.linspace(dem_alts, fac_alts, ncols, axis=1, dtype=dtype)
+
+    samples = sampler.batched_sample(segments[:, :, 0].ravel(), segments[:, :, 1].ravel())
+
+    X = np.empty((n, ncols + 3), dtype=dtype)
+    X[:, 0] = 1.0
+    X[:, 1:-2] = altitudes - np.asarray(samples, dtype=dtype).reshape((n, ncols))
+    X[:, -2] = np.log(0.01 + np.hypot(dem_xy[:, 0] - fac_xy[:, 0], dem_xy[:, 1] - fac_xy[:, 1]))
+    X[:, -1] = np.log(0.01 + np.absolute(dem_alts - fac_alts))
+
+    return X
+
 class ML253FeaturesInput():
     """A class for generating ml model inputs using the 253 feature model.
     The input contains 250 line of sight samples, the log-distance, 
@@ -18,47 +70,47 @@ class ML253FeaturesInput():
     :type facs: gpd.GeoDataFrame
     :param sampler: an instance of geo.sampler.LinkSampler instantiated with dems and facs
     :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`
+    :param ncols: the number of line of sight samples, defaults to 250
+    :type ncols: int, optional
+    :param chunk_size: the most demand points to generate inputs for at once.
+        Bounds the memory used for sample points and line of sight profiles no
+        matter how many demand points there are. If None, all demand points are
+        done at once, defaults to None
+    :type chunk_size: int, optional
+    :param dtype: the float type of the generated inputs. np.float32 halves the
+        memory of the inputs, defaults to np.float64
+    :type dtype: np.dtype, optional
     """
-    def __init__(self, dems, facs, sampler, ncols=250):
+    def __init__(self, dems, facs, sampler, ncols=250, chunk_size=None, dtype=np.float64):
         """Constructor method
         """
         self._dems = dems
         self._facs = facs
+        self._dem_points = PointStore(dems)
+        self._fac_points = PointStore(facs)
         self._sampler = sampler
         self._ncols = ncols
+        self._chunk_size = chunk_size
+        self._dtype = np.dtype(dtype)
         self._all_dems = np.full(len(dems), True)
 
-    def _generate_sample_points(self, fac, dems=None):
-        # Returns the locations to sample, the shape to reshape to after sampling, and altitudes
-        if dems is None:
-            dems = self._all_dems
+    @property
+    def dtype(self):
+        """The float type of the generated inputs
+
+        :return: the dtype of each input matrix
+        :rtype: np.dtype
+        """
+        return self._dtype
 
-        fac_start = False # When true the line segment originates from the facility, usually false
-        if fac_start:
-            fs, ds = (0, 1)
-        else:
-            fs, ds = (1, 0)
-        
-        segments = np.empty((dems.sum(), 2, 2))
-        segments[:, fs, 0] = self._facs.geometry[fac].x
-        segments[:, fs, 1] = self._facs.geometry[fac].y
-        segments[:, ds, 0] = self._dems.geometry.x[dems]
-        segments[:, ds, 1] = self._dems.geometry.y[dems]
-
-        altitudes = np.empty((dems.sum(), 2))
-        altitudes[:, fs] = self._facs['altitude'][fac]
-        altitudes[:, ds] = self._dems['altitude'][dems]
-        
-        segments = np.linspace(segments[:, 0, :], segments[:, 1, :], self._ncols, axis=1)
-        altitudes = np.linspace(altitudes[:, 0], altitudes[:, 1], self._ncols, axis=1)
-
-        seg_shape = segments.shape
-        return (segments.reshape((seg_shape[0] * seg_shape[1], seg_shape[2])), [seg_shape, altitudes])
-    
-    def _reshape_samples(self, arr, seg_shape, altitudes):
-        # Reshape the samples back after sampling
-        arr = arr.reshape(seg_shape[:2])
-        return (altitudes - arr)
+    @property
+    def n_inputs(self):
+        """The number of inputs per link
+
+        :return: ncols + 3, the number of columns of each input matrix
+        :rtype: int
+        """
+        return self._ncols + 3
 
     def get_input(self, fac, dems=None):
         """Get the input from fac to dems, includes the constant
@@ -73,23 +125,88 @@ class ML253FeaturesInput():
             the demand points, the second being the 253 inputs.
         :rtype: np.ndarray
         """
+        blocks = list(self.iter_input(fac, dems))
+        if len(blocks) == 1:
+            return blocks[0]
+        return np.concatenate(blocks)
+
+    def iter_input(self, fac, dems=None):
+        """Generate the input from fac to dems in blocks of at most chunk_size
+        demand points, includes the constant. Concatenating the blocks gives
+        get_input(fac, dems)
+
+        :param fac: the facility to get input from
+        :type fac: int
+        :param dems: a boolean numpy array of the demand points to get. 
+            Will get the inputs to each demand point where dems[i] is True.
+            If None then get the input to all demand points, defaults to None
+        :type dems: np.ndarray
+        :returns: a generator of 2D numpy matrices of the input floats with the first
+            dimension being the demand points, the second being the 253 inputs.
+        :rtype: Iterator[np.ndarray]
+        """
         if dems is None:
             dems = self._all_dems
-        distances = np.log(0.01 + self._dems[dems].distance(self._facs.geometry[fac]).to_numpy())
-        heights = np.log(0.01 + np.absolute(self._dems['altitude'][dems] - self._facs['altitude'][fac]))
+        dem_idx = np.flatnonzero(dems)
+        fac_xy = self._fac_points.xy(fac)[0]
+        fac_alt = self._fac_points.altitudes[fac]
+
+        step = max(1, len(dem_idx) if self._chunk_size is None else self._chunk_size)
+        for start in range(0, max(1, len(dem_idx)), step):
+            block = dem_idx[start:start + step]
+            yield link_features(self._sampler, fac_xy, fac_alt, self._dem_points.xy(block), self._dem_points.altitudes[block], self._ncols, self._dtype)
+
+    def get_link_inputs(self, facs, dems):
+        """Get the inputs for many (facility, demand point) links in one
+        vectorized call, includes the constant
+
+        :param facs: an integer numpy array of the facility end of each link
+        :type facs: np.ndarray
+        :param dems: an integer numpy array of the demand point end of each
+            link with len(dems) == len(facs)
+        :type dems: np.ndarray
+        :returns: a 2D numpy matrix of the input floats with the first dimension being
+            the links, the second being the 253 inputs.
+        :rtype: np.ndarray
+        """
+        fac_xy = self._fac_points.xy(facs)
+        dem_xy = self._dem_points.xy(dems)
 
-        samples, args = self._generate_sample_points(fac, dems)
-        samples = self._sampler.batched_sample(samples[:, 0], samples[:, 1])
-        los = self._reshape_samples(samples, *args)
+        return link_features(self._sampler, fac_xy, self._fac_points.altitudes[facs], dem_xy, self._dem_points.altitudes[dems], self._ncols, self._dtype)
 
-        X = np.empty((los.shape[0], los.shape[1] + 2))
-        X[:, :-2] = los
-        X[:, -2] = distances
-        X[:, -1] = heights
+def facility_prrs(input_gen, model, facs, dems):
+    """Run model on the inputs from many facilities one block of demand points
+    at a time. Each call to model.forward stacks the block's inputs for every
+    facility, so memory stays bounded by the input generator's chunk_size
 
-        return sm.add_constant(X, has_constant='add')
+    :param input_gen: the input generator to take inputs from, such as an
+        ML253FeaturesInput or a FeatureStore
+    :type input_gen: class: `iot_net_planner.prediction.ml_253_input.ML253FeaturesInput`
+    :param model: a model with a forward method taking an n by n_inputs matrix
+        and returning n predictions
+    :type model: object
+    :param facs: the facilities to generate prrs from
+    :type facs: list[int]
+    :param dems: a boolean numpy array of the demand points to generate prrs to
+    :type dems: np.ndarray
+    :returns: a 2d numpy array with shape (dems.sum(), len(facs)) where
+        column j holds the prrs from facs[j]
+    :rtype: np.ndarray
+    """
+    prrs = None
+    row = 0
+    for blocks in zip(*[input_gen.iter_input(fac, dems) for fac in facs]):
+        n = len(blocks[0])
+        block_prrs = model.forward(np.concatenate(blocks)).reshape((len(facs), n)).T
+        if prrs is None:
+            prrs = np.empty((dems.sum(), len(facs)), dtype=block_prrs.dtype)
+        prrs[row:row + n] = block_prrs
+        row += n
+    if prrs is None:
+        prrs = np.empty((dems.sum(), len(facs)))
+    return prrs
 
-def make_traindata(link_file, sampler, x_out, y_out, crs=None, logging=False):
+def make_traindata(link_file, sampler, x_out, y_out, crs=None, logging=False, chunk_size=4096, n_workers=1, sampler_factory=None, dtype=np.float64):
     """Create and save training data for a given training dataset
 
     :param link_file: a path to a GeoDataFrame containing the data.
@@ -120,6 +237,19 @@ def make_traindata(link_file, sampler, x_out, y_out, crs=None, logging=False):
     :param logging: boolean representing if progress should be 
         printed, defaults to False
     :type logging: bool, optional
+    :param chunk_size: the number of links to featurize in each
+        vectorized call, defaults to 4096
+    :type chunk_size: int, optional
+    :param n_workers: the number of processes to featurize links with,
+        defaults to 1
+    :type n_workers: int, optional
+    :param sampler_factory: required when n_workers > 1. A picklable function
+        returning a new sampler equivalent to sampler, such as
+        functools.partial(DSMSampler, crs, dsm_path, 0), so each worker can
+        open its own, defaults to None
+    :type sampler_factory: Callable, optional
+    :param dtype: the float type of the saved training inputs, defaults to np.float64
+    :type dtype: np.dtype, optional
     """
     def ends_in(s, ending):
         return s[-1*len(ending):] == ending
@@ -140,22 +270,203 @@ def make_traindata(link_file, sampler, x_out, y_out, crs=None, logging=False):
     facs = gpd.GeoDataFrame(geometry=gpd.GeoSeries([second_pt(i) for i in links.geometry]), crs=crs)
     facs['altitude'] = links['ele_gw']
 
-    X = np.empty((len(links), 253))
     y = np.array([int(i) for i in links['success']])
 
-    input_gen = ML253FeaturesInput(dems, facs, sampler)
+    input_gen = ML253FeaturesInput(dems, facs, sampler, dtype=dtype)
+
+    # Link i runs from facs[i] to dems[i]
+    links_idx = np.arange(len(links))
+    raw_out = x_out[:-len(".npy")] + ".raw.npy"
+    featurize_links(input_gen, links_idx, links_idx, raw_out, chunk_size, logging, n_workers, sampler_factory)
+    filter_traindata(raw_out, y, x_out, y_out, chunk_size=chunk_size)
+    remove_featurized(raw_out)
+
+def _manifest_path(x_out):
+    return x_out[:-len(".npy")] + ".chunks.json"
+
+def _inputs_digest(input_gen, facs, dems):
+    # A digest of everything the featurized rows depend on, so a resumed run
+    # never mixes in rows computed from different links or terrain
+    digest = hashlib.sha256()
+    for points, idx in ((input_gen._fac_points, facs), (input_gen._dem_points, dems)):
+        idx = np.asarray(idx, dtype=np.int64)
+        digest.update(idx.tobytes())
+        digest.update(np.ascontiguousarray(points.xs[idx]).tobytes())
+        digest.update(np.ascontiguousarray(points.ys[idx]).tobytes())
+        if points.altitudes is not None:
+            digest.update(np.ascontiguousarray(points.altitudes[idx]).tobytes())
+    fingerprint = getattr(input_gen._sampler, 'fingerprint', lambda: None)()
+    digest.update(json.dumps([input_gen._ncols, input_gen.dtype.name, fingerprint]).encode())
+    return digest.hexdigest()
 
-    for i in range(len(links)):
+def featurize_links(input_gen, facs, dems, x_out, chunk_size=4096, logging=False, n_workers=1, sampler_factory=None):
+    """Featurize links chunk by chunk straight into a memory-mapped '.npy'
+    file. Finished chunks are recorded in a '.chunks.json' manifest next to
+    x_out, so if the run is interrupted, calling this again with the same
+    arguments skips the chunks that are already done. The manifest records a
+    digest of the link endpoints, ncols, dtype and the sampler's fingerprint,
+    and the run starts over if any of them changed.
+
+    :param input_gen: the input generator to featurize with
+    :type input_gen: class: `iot_net_planner.prediction.ml_253_input.ML253FeaturesInput`
+    :param facs: an integer numpy array of the facility end of each link
+    :type facs: np.ndarray
+    :param dems: an integer numpy array of the demand point end of each
+        link with len(dems) == len(facs)
+    :type dems: np.ndarray
+    :param x_out: the path to write the unfiltered inputs to. The file
+        should be a '.npy' file, and this extension will be appended
+        if it is not present
+    :type x_out: str
+    :param chunk_size: the number of links per chunk, defaults to 4096
+    :type chunk_size: int, optional
+    :param logging: boolean representing if progress should be 
+        printed, defaults to False
+    :type logging: bool, optional
+    :param n_workers: the number of processes featurizing chunks in parallel.
+        Each worker opens its own sampler with sampler_factory and writes its
+        chunks into x_out directly, defaults to 1
+    :type n_workers: int, optional
+    :param sampler_factory: required when n_workers > 1. A picklable function
+        returning a new sampler, such as functools.partial(DSMSampler, crs, dsm_path, 0),
+        defaults to None
+    :type sampler_factory: Callable, optional
+    :returns: the path of the written inputs, row i holds link i
+    :rtype: str
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    if n_workers > 1 and sampler_factory is None:
+        raise ValueError("A sampler_factory is needed to featurize with more than one worker")
+
+    x_out += (not ends_in(x_out, ".npy")) * ".npy"
+    manifest_path = _manifest_path(x_out)
+    shape = [len(facs), input_gen.n_inputs]
+
+    # Resume only if the manifest describes the same layout and inputs
+    inputs = _inputs_digest(input_gen, facs, dems)
+    manifest = None
+    if os.path.exists(manifest_path) and os.path.exists(x_out):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest['shape'] != shape or manifest['chunk_size'] != chunk_size or manifest.get('inputs') != inputs:
+            manifest = None
+
+    if manifest is None:
+        manifest = {'shape': shape, 'chunk_size': chunk_size, 'inputs': inputs, 'done': []}
+        X = open_memmap(x_out, mode='w+', dtype=input_gen.dtype, shape=tuple(shape))
+    else:
+        X = open_memmap(x_out, mode='r+')
+
+    def record(chunk):
+        # Replace the manifest atomically so a crash never leaves it half written
+        manifest['done'].append(chunk)
+        with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + ".tmp", manifest_path)
         if logging:
-            print(f"{i+1} / {len(links)}", end="\r")
-        dem_choice = np.full(len(dems), False)
-        dem_choice[i] = True
-        X[i] = input_gen.get_input(i, dem_choice)[0]
-    
-    finite_mask = np.isfinite(X)
-    finite_rows = np.all(finite_mask, axis=1)
-    X = X[finite_rows]
-    y = y[finite_rows]
-
-    np.save(x_out, X)
-    np.save(y_out, y)
+            print(f"{len(manifest['done'])} / {n_chunks} chunks", end="\r")
+
+    done = set(manifest['done'])
+    n_chunks = -(-len(facs) // chunk_size)
+    todo = [chunk for chunk in range(n_chunks) if chunk not in done]
+    bounds = [(chunk * chunk_size, min((chunk + 1) * chunk_size, len(facs))) for chunk in todo]
+
+    if n_workers <= 1:
+        for chunk, (start, stop) in zip(todo, bounds):
+            X[start:stop] = input_gen.get_link_inputs(facs[start:stop], dems[start:stop])
+            X.flush()
+            record(chunk)
+        del X
+        return x_out
+
+    # Workers write into the file themselves, the manifest is only kept here
+    del X
+    initargs = (sampler_factory, input_gen._dems, input_gen._facs, input_gen._ncols, input_gen.dtype)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=initargs) as executor:
+        futures = {
+            executor.submit(_featurize_chunk, x_out, start, stop, facs[start:stop], dems[start:stop]): chunk
+            for chunk, (start, stop) in zip(todo, bounds)
+        }
+        for future in as_completed(futures):
+            future.result()
+            record(futures[future])
+
+    return x_out
+
+# The input generator of a featurize_links worker process
+_worker_input_gen = None
+
+def _init_worker(sampler_factory, dems, facs, ncols, dtype):
+    # Open this worker's own sampler once
+    global _worker_input_gen
+    _worker_input_gen = ML253FeaturesInput(dems, facs, sampler_factory(), ncols, dtype=dtype)
+
+def _featurize_chunk(x_out, start, stop, facs, dems):
+    # Featurize one chunk in a worker and write it into the shared output
+    X = open_memmap(x_out, mode='r+')
+    X[start:stop] = _worker_input_gen.get_link_inputs(facs, dems)
+    X.flush()
+    del X
+
+def filter_traindata(x_in, y, x_out, y_out, nodata=None, chunk_size=4096):
+    """Remove the links with non-finite inputs from featurized training data
+    in a streaming pass, so the inputs never need to fit in memory
+
+    :param x_in: a path to the '.npy' inputs written by featurize_links
+    :type x_in: str
+    :param y: the training outputs with one entry per row of x_in
+    :type y: np.ndarray
+    :param x_out: the path to put the filtered training inputs. The file
+        should be a '.npy' file, and this extension will be appended
+        if it is not present
+    :type x_out: str
+    :param y_out: the path to put the filtered training outputs. The file
+        should be a '.npy' file, and this extension will be appended
+        if it is not present
+    :type y_out: str
+    :param nodata: if not None, links with any input at or below this value,
+        such as those sampling outside the DSM, are removed too, defaults to None
+    :type nodata: float, optional
+    :param chunk_size: the number of rows read at a time, defaults to 4096
+    :type chunk_size: int, optional
+    :returns: a boolean numpy array of which links were kept
+    :rtype: np.ndarray
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    x_out += (not ends_in(x_out, ".npy")) * ".npy"
+    y_out += (not ends_in(y_out, ".npy")) * ".npy"
+
+    X = np.load(x_in, mmap_mode='r')
+    keep = np.empty(len(X), dtype=bool)
+    for start in range(0, len(X), chunk_size):
+        rows = X[start:start + chunk_size]
+        valid = np.all(np.isfinite(rows), axis=1)
+        if nodata is not None:
+            valid &= np.all(rows > nodata, axis=1)
+        keep[start:start + chunk_size] = valid
+
+    X_kept = open_memmap(x_out, mode='w+', dtype=X.dtype, shape=(int(keep.sum()), X.shape[1]))
+    written = 0
+    for start in range(0, len(X), chunk_size):
+        rows = X[start:start + chunk_size][keep[start:start + chunk_size]]
+        X_kept[written:written + len(rows)] = rows
+        written += len(rows)
+    X_kept.flush()
+    del X_kept
+
+    np.save(y_out, np.asarray(y)[keep])
+    return keep
+
+def remove_featurized(x_out):
+    """Remove the inputs and manifest written by featurize_links once they are
+    no longer needed
+
+    :param x_out: the path of the inputs returned by featurize_links
+    :type x_out: str
+    """
+    os.remove(x_out)
+    os.remove(_manifest_path(x_out))
@@ -2,59 +2,115 @@
 A prr implementation for the log(distance), los, log(distance) * los model
 """
 from iot_net_planner.prediction.prr_model import PRRModel
+from iot_net_planner.prediction.point_store import PointStore
+from iot_net_planner.prediction.onnx_pipeline import OnnxModel
+from iot_net_planner.prediction.ml_models.torch_weights import load_state_dict
 
 import numpy as np
-import torch
-import torch.nn as nn
 
-class LogisticRegression(nn.Module):
-    def __init__(self, n_inputs, n_outputs):
-        super(LogisticRegression, self).__init__()
-        self.linear = nn.Linear(n_inputs, n_outputs)
-
-    def forward(self, x):
-        x = torch.from_numpy(x)
-        y_predicted = torch.sigmoid(self.linear(x))
-        return y_predicted
-
-class LogisticModel():
+class NumpyLogisticModel():
     def __init__(self, path, sc, n_inputs=3, n_outputs=1):
-        self.model = LogisticRegression(n_inputs, n_outputs).double()
-        self.model.load_state_dict(torch.load(path))
+        # Read the linear layer once, evaluating it needs no torch
+        state = load_state_dict(path, np.float64)
+        self._weights = state['linear.weight'].reshape((n_outputs, n_inputs))
+        self._bias = state['linear.bias']
         self._sc = sc
 
     def forward(self, log_distance, los):
-        x = np.zeros((len(log_distance), 3))
+        x = np.empty((len(log_distance), 3))
         x[:, 0] = log_distance
         x[:, 1] = los
         x[:, 2] = log_distance * los
-        
+
         x = self._sc.run(None, {"X": x})[0]
-        
-        return self.model.forward(x).detach().numpy().flatten()
+
+        return (1.0 / (1.0 + np.exp(-(x @ self._weights.T + self._bias)))).ravel()
+
+class FusedLogisticModel():
+    def __init__(self, path, n_threads=None):
+        # A pipeline written by onnx_pipeline.export_los3_pipeline
+        self.model = OnnxModel(path, n_threads)
+
+    def forward(self, log_distance, los):
+        x = np.column_stack([log_distance, los, log_distance * los])
+        return self.model.forward(x)
+
+def __getattr__(name):
+    # The torch model classes are only imported when asked for
+    if name in ('LogisticRegression', 'LogisticModel'):
+        from iot_net_planner.prediction.ml_models import torch_logistic
+        return getattr(torch_logistic, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class LOS3Features(PRRModel):
-    def __init__(self, dems, facs, sampler, model_path, standard_scalar, ncols=150):
+    """A PRRModel using a logistic regression on log(distance), the fraction of
+    the link with line of sight, and their product
+
+    :param dems: the demand points to use
+    :type dems: gpd.GeoDataFrame
+    :param facs: the gateways to use
+    :type facs: gpd.GeoDataFrame
+    :param sampler: the sampler to use
+    :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`
+    :param model_path: a path to the model's .pth file, or to the fused .onnx
+        pipeline written by onnx_pipeline.export_los3_pipeline when backend is 'onnx'
+    :type model_path: str
+    :param standard_scalar: an onnxruntime InferenceSession of the model's standard
+        scaler. Required by the 'numpy' and 'torch' backends, and must be None for
+        the 'onnx' backend since the pipeline already includes it, defaults to None
+    :type standard_scalar: onnxruntime.InferenceSession, optional
+    :param ncols: the number of samples along each link, defaults to 150
+    :type ncols: int, optional
+    :param chunk_size: the most demand points to compute prrs for at once.
+        If None, all demand points are done at once, defaults to None
+    :type chunk_size: int, optional
+    :param n_threads: only used when backend is 'onnx'. The number of threads
+        onnxruntime uses within each operator. If None, onnxruntime picks its
+        default, defaults to None
+    :type n_threads: int, optional
+    :param backend: how the model is evaluated. 'numpy' reads the .pth weights
+        without importing torch, 'torch' runs the torch model, and 'onnx' runs
+        a fused scaler and model pipeline, defaults to 'numpy'
+    :type backend: str, optional
+    """
+    def __init__(self, dems, facs, sampler, model_path, standard_scalar=None, ncols=150, chunk_size=None, n_threads=None, backend='numpy'):
+        """Constructor method
+        """
+        if backend not in ('numpy', 'torch', 'onnx'):
+            raise ValueError(f"Unknown backend '{backend}', expected 'numpy', 'torch', or 'onnx'")
+        if backend == 'onnx' and standard_scalar is not None:
+            raise ValueError("The 'onnx' backend runs a fused pipeline that already includes the scaler, pass standard_scalar=None")
+        if backend != 'onnx' and standard_scalar is None:
+            raise ValueError(f"The '{backend}' backend needs a standard_scalar, or use backend='onnx' with a fused pipeline")
+
         self._dems = dems
         self._facs = facs
+        self._dem_points = PointStore(dems)
+        self._fac_points = PointStore(facs)
         self._sampler = sampler
         self._ncols = ncols
-        self._model = LogisticModel(model_path, standard_scalar)
+        self._chunk_size = chunk_size
+        # The numpy backend evaluates the same weights as the torch one without importing torch
+        if backend == 'onnx':
+            self._model = FusedLogisticModel(model_path, n_threads)
+        elif backend == 'numpy':
+            self._model = NumpyLogisticModel(model_path, standard_scalar)
+        else:
+            from iot_net_planner.prediction.ml_models.torch_logistic import LogisticModel
+            self._model = LogisticModel(model_path, standard_scalar)
         self._all_dems = np.full(len(dems), True)
 
-    def _generate_sample_points(self, fac, dems=None):
-        if dems is None:
-            dems = np.full(len(self._dems), True)
-        
-        segments = np.empty((dems.sum(), 2, 2))
-        segments[:, 0, 0] = self._facs.geometry[fac].x
-        segments[:, 0, 1] = self._facs.geometry[fac].y
-        segments[:, 1, 0] = self._dems.geometry.x[dems]
-        segments[:, 1, 1] = self._dems.geometry.y[dems]
-
-        altitudes = np.empty((dems.sum(), 2))
-        altitudes[:, 0] = self._facs['altitude'][fac]
-        altitudes[:, 1] = self._dems['altitude'][dems]
+    def _generate_sample_points(self, fac, dems):
+        # dems is an integer array of demand point positions
+        segments = np.empty((len(dems), 2, 2))
+        segments[:, 0, 0] = self._fac_points.xs[fac]
+        segments[:, 0, 1] = self._fac_points.ys[fac]
+        segments[:, 1, 0] = self._dem_points.xs[dems]
+        segments[:, 1, 1] = self._dem_points.ys[dems]
+
+        altitudes = np.empty((len(dems), 2))
+        altitudes[:, 0] = self._fac_points.altitudes[fac]
+        altitudes[:, 1] = self._dem_points.altitudes[dems]
         
         segments = np.linspace(segments[:, 0, :], segments[:, 1, :], self._ncols, axis=1)
         altitudes = np.linspace(altitudes[:, 0], altitudes[:, 1], self._ncols, axis=1)
@@ -66,6 +122,15 @@ class LOS3Features(PRRModel):
         arr = arr.reshape(seg_shape[:2])
         return (altitudes >= arr).mean(axis=1)
 
+    def _distances(self, fac, dems):
+        return self._dem_points.distances(self._fac_points.xs[fac], self._fac_points.ys[fac], dems)
+
+    def _blocks(self, dems):
+        # Split the chosen demand points into blocks of at most chunk_size positions
+        dem_idx = np.flatnonzero(dems)
+        step = max(1, len(dem_idx) if self._chunk_size is None else self._chunk_size)
+        return [dem_idx[start:start + step] for start in range(0, max(1, len(dem_idx)), step)]
+
     @property
     def dems(self):
         return self._dems
@@ -77,18 +142,25 @@ class LOS3Features(PRRModel):
     def get_prr(self, fac, dems=None):
         if dems is None:
             dems = self._all_dems
-        distances = np.log(self._dems[dems].distance(self._facs.geometry[fac]).to_numpy())
 
-        samples, args = self._generate_sample_points(fac, dems)
-        samples = self._sampler.batched_sample(samples[:, 0], samples[:, 1])
-        los = self._reshape_samples(samples, *args)
-        
-        return self._model.forward(distances, los)
+        prrs = []
+        for block in self._blocks(dems):
+            distances = np.log(self._distances(fac, block))
+
+            samples, args = self._generate_sample_points(fac, block)
+            samples = self._sampler.batched_sample(samples[:, 0], samples[:, 1])
+            los = self._reshape_samples(samples, *args)
+
+            prrs.append(self._model.forward(distances, los))
+
+        if len(prrs) == 1:
+            return prrs[0]
+        return np.concatenate(prrs)
 
     def get_prr_ub(self, fac, dems=None):
         if dems is None:
             dems = self._all_dems
-        distances = np.log(self._dems[dems].distance(self._facs.geometry[fac]).to_numpy())
+        distances = np.log(self._distances(fac, dems))
         los = np.ones(len(distances))
 
         return self._model.forward(distances, los)
@@ -97,7 +169,7 @@ class LOS3Features(PRRModel):
     def get_prr_lb(self, fac, dems=None):
         if dems is None:
             dems = self._all_dems
-        distances = np.log(self._dems[dems].distance(self._facs.geometry[fac]).to_numpy())
+        distances = np.log(self._distances(fac, dems))
         los = np.zeros(len(distances))
 
         return self._model.forward(distances, los)
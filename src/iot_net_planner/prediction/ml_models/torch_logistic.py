@@ -0,0 +1,32 @@
+"""The torch implementation of the 3 feature logistic regression used by
+los_model_3features. Importing this module imports torch.
+"""
+import numpy as np
+import torch
+import torch.nn as nn
+
+class LogisticRegression(nn.Module):
+    def __init__(self, n_inputs, n_outputs):
+        super(LogisticRegression, self).__init__()
+        self.linear = nn.Linear(n_inputs, n_outputs)
+
+    def forward(self, x):
+        x = torch.from_numpy(x)
+        y_predicted = torch.sigmoid(self.linear(x))
+        return y_predicted
+
+class LogisticModel():
+    def __init__(self, path, sc, n_inputs=3, n_outputs=1):
+        self.model = LogisticRegression(n_inputs, n_outputs).double()
+        self.model.load_state_dict(torch.load(path))
+        self._sc = sc
+
+    def forward(self, log_distance, los):
+        x = np.zeros((len(log_distance), 3))
+        x[:, 0] = log_distance
+        x[:, 1] = los
+        x[:, 2] = log_distance * los
+        
+        x = self._sc.run(None, {"X": x})[0]
+        
+        return self.model.forward(x).detach().numpy().flatten()
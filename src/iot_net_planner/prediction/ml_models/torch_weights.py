@@ -0,0 +1,75 @@
+"""A reader for the weights saved by torch.save that needs neither torch nor
+its import time. Only plain tensors in a state dict are supported, and only
+the classes those need are unpickled.
+"""
+import pickle
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+# The numpy type of each torch storage class
+_STORAGE_DTYPES = {
+    'DoubleStorage': np.float64,
+    'FloatStorage': np.float32,
+    'HalfStorage': np.float16,
+    'LongStorage': np.int64,
+    'IntStorage': np.int32,
+    'ShortStorage': np.int16,
+    'CharStorage': np.int8,
+    'ByteStorage': np.uint8,
+    'BoolStorage': np.bool_,
+}
+
+def _rebuild_tensor(storage, offset, size, stride, requires_grad=False, backward_hooks=None, metadata=None):
+    # Build the tensor's array from its storage, copied so it owns its memory
+    itemsize = storage.dtype.itemsize
+    return np.lib.stride_tricks.as_strided(storage[offset:], shape=tuple(size), strides=tuple(s * itemsize for s in stride)).copy()
+
+class _WeightsUnpickler(pickle.Unpickler):
+    # Unpickles a state dict, reading tensor storages from the archive
+    def __init__(self, file, archive, prefix, byteorder):
+        super().__init__(file)
+        self._archive = archive
+        self._prefix = prefix
+        self._byteorder = byteorder
+
+    def find_class(self, module, name):
+        if module == 'torch._utils' and name == '_rebuild_tensor_v2':
+            return _rebuild_tensor
+        if module == 'torch' and name in _STORAGE_DTYPES:
+            return np.dtype(_STORAGE_DTYPES[name]).newbyteorder(self._byteorder)
+        if module == 'collections' and name == 'OrderedDict':
+            return OrderedDict
+        raise pickle.UnpicklingError(f"Cannot load {module}.{name} without torch")
+
+    def persistent_load(self, pid):
+        _, dtype, key, _, numel = pid
+        data = self._archive.read(f"{self._prefix}/data/{key}")
+        return np.frombuffer(data, dtype=dtype, count=numel).astype(dtype.newbyteorder('='))
+
+def load_state_dict(path, dtype=None):
+    """Load a state dict saved by torch.save into numpy arrays
+
+    :param path: a path to the '.pth' file, written in torch's zip format
+    :type path: str
+    :param dtype: if not None, every array is cast to this type, defaults to None
+    :type dtype: np.dtype, optional
+    :returns: an ordered dict from each parameter name to its numpy array
+    :rtype: OrderedDict
+    """
+    if not zipfile.is_zipfile(path):
+        raise ValueError(f"{path} is not in torch's zip format, resave it with a newer torch")
+
+    with zipfile.ZipFile(path) as archive:
+        pickle_name = next(name for name in archive.namelist() if name.endswith("/data.pkl"))
+        prefix = pickle_name[:-len("/data.pkl")]
+        byteorder = '<'
+        if f"{prefix}/byteorder" in archive.namelist():
+            byteorder = '<' if archive.read(f"{prefix}/byteorder").decode().strip() == 'little' else '>'
+        with archive.open(pickle_name) as f:
+            state = _WeightsUnpickler(f, archive, prefix, byteorder).load()
+
+    if dtype is not None:
+        state = OrderedDict((name, array.astype(dtype)) for name, array in state.items())
+    return state
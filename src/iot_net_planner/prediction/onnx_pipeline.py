@@ -0,0 +1,362 @@
+"""Tools for fusing a standard scaler and a trained classifier into a single
+ONNX graph, and a PRRModel that runs it. One runtime call per batch replaces
+the scaler session plus the xgboost, statsmodels or torch hand-off.
+"""
+import json
+
+import numpy as np
+from onnxruntime import InferenceSession, SessionOptions
+
+from iot_net_planner.prediction.prr_model import PRRModel
+from iot_net_planner.prediction.ml_253_input import ML253FeaturesInput, facility_prrs
+from iot_net_planner.prediction.feature_store import FeatureStore
+from iot_net_planner.prediction.ml_models.torch_weights import load_state_dict
+
+# The name of the output of every fused pipeline
+_OUTPUT = "prr"
+
+def _fuse(sc_path, nodes, initializers, out_type, out_path):
+    # Append nodes reading the scaler's output to the scaler graph and save it
+    import onnx
+    from onnx import helper
+
+    scaler = onnx.load(sc_path)
+    graph = scaler.graph
+    nodes = [helper.make_node(op, [graph.output[0].name if i == "scaled" else i for i in inputs], outputs, **attrs)
+             for op, inputs, outputs, attrs in nodes]
+
+    fused = helper.make_graph(
+        list(graph.node) + nodes,
+        "prr_pipeline",
+        list(graph.input),
+        [helper.make_tensor_value_info(_OUTPUT, out_type, [None])],
+        list(graph.initializer) + initializers,
+    )
+    opsets = {opset.domain: opset.version for opset in scaler.opset_import}
+    opsets[""] = max(opsets.get("", 1), 13)
+    if any(node.domain == "ai.onnx.ml" for node in nodes):
+        opsets["ai.onnx.ml"] = max(opsets.get("ai.onnx.ml", 1), 3)
+    model = helper.make_model(fused, opset_imports=[helper.make_opsetid(d, v) for d, v in opsets.items()])
+    model.ir_version = scaler.ir_version
+    onnx.checker.check_model(model)
+
+    with open(out_path, "wb") as f:
+        f.write(model.SerializeToString())
+    return out_path
+
+def _scaler_dtype(sc_path):
+    # The numpy float type the scaler graph takes and returns
+    import onnx
+    from onnx import TensorProto
+
+    elem_type = onnx.load(sc_path).graph.input[0].type.tensor_type.elem_type
+    return np.float32 if elem_type == TensorProto.FLOAT else np.float64
+
+def export_xg_pipeline(model_path, sc_path, out_path):
+    """Fuse a standard scaler and an xgboost model trained with
+    xg_253features.train_xg_253_model into a single ONNX graph.
+    The trees are converted to an ONNX tree ensemble that compares
+    float32 features, as xgboost does.
+
+    :param model_path: a path to the model's .json file
+    :type model_path: str
+    :param sc_path: a path to the model's standard scaler .onnx file
+    :type sc_path: str
+    :param out_path: the file path to write the pipeline to. The file
+        extension should be '.onnx', and this will be appended if it is not present
+    :type out_path: str
+    :returns: the path of the written pipeline
+    :rtype: str
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    import xgboost as xgb
+    from onnx import numpy_helper, TensorProto
+
+    out_path += (not ends_in(out_path, ".onnx")) * ".onnx"
+
+    booster = xgb.Booster()
+    booster.load_model(model_path)
+    config = json.loads(booster.save_config())['learner']
+    if config['objective']['name'] != 'binary:logistic':
+        raise ValueError(f"Only binary:logistic models can be exported, not {config['objective']['name']}")
+    base_score = float(config['learner_model_param']['base_score'].strip('[]'))
+    names = booster.feature_names
+
+    attrs = {key: [] for key in (
+        'nodes_treeids', 'nodes_nodeids', 'nodes_featureids', 'nodes_modes', 'nodes_values',
+        'nodes_truenodeids', 'nodes_falsenodeids', 'nodes_missing_value_tracks_true',
+        'target_treeids', 'target_nodeids', 'target_ids', 'target_weights',
+    )}
+    for tree_id, dump in enumerate(booster.get_dump(dump_format='json')):
+        stack = [json.loads(dump)]
+        while stack:
+            node = stack.pop()
+            attrs['nodes_treeids'].append(tree_id)
+            attrs['nodes_nodeids'].append(node['nodeid'])
+            if 'leaf' in node:
+                attrs['nodes_featureids'].append(0)
+                attrs['nodes_modes'].append('LEAF')
+                attrs['nodes_values'].append(0.0)
+                attrs['nodes_truenodeids'].append(0)
+                attrs['nodes_falsenodeids'].append(0)
+                attrs['nodes_missing_value_tracks_true'].append(0)
+                attrs['target_treeids'].append(tree_id)
+                attrs['target_nodeids'].append(node['nodeid'])
+                attrs['target_ids'].append(0)
+                attrs['target_weights'].append(node['leaf'])
+                continue
+            split = node['split']
+            attrs['nodes_featureids'].append(names.index(split) if names else int(split[1:]))
+            attrs['nodes_modes'].append('BRANCH_LT')
+            attrs['nodes_values'].append(node['split_condition'])
+            attrs['nodes_truenodeids'].append(node['yes'])
+            attrs['nodes_falsenodeids'].append(node['no'])
+            attrs['nodes_missing_value_tracks_true'].append(int(node['missing'] == node['yes']))
+            stack.extend(node['children'])
+
+    nodes = [
+        ("Cast", ["scaled"], ["scaled_float"], {'to': TensorProto.FLOAT}),
+        ("TreeEnsembleRegressor", ["scaled_float"], ["margin"], dict(
+            attrs, domain="ai.onnx.ml", n_targets=1, aggregate_function='SUM',
+            base_values=[float(np.log(base_score / (1 - base_score)))], post_transform='NONE',
+        )),
+        ("Sigmoid", ["margin"], ["prob"], {}),
+        ("Squeeze", ["prob", "squeeze_axes"], [_OUTPUT], {}),
+    ]
+    initializers = [numpy_helper.from_array(np.array([1], dtype=np.int64), "squeeze_axes")]
+    return _fuse(sc_path, nodes, initializers, TensorProto.FLOAT, out_path)
+
+def _linear_pipeline(sc_path, weights, bias, sigmoid, out_path):
+    # Fuse the scaler with a linear model, optionally passed through a sigmoid
+    from onnx import numpy_helper, TensorProto
+
+    dtype = _scaler_dtype(sc_path)
+    initializers = [
+        numpy_helper.from_array(np.asarray(weights, dtype=dtype).reshape((-1, 1)), "weights"),
+        numpy_helper.from_array(np.asarray([bias], dtype=dtype), "bias"),
+        numpy_helper.from_array(np.array([1], dtype=np.int64), "squeeze_axes"),
+    ]
+    nodes = [
+        ("MatMul", ["scaled", "weights"], ["product"], {}),
+        ("Add", ["product", "bias"], ["linear"], {}),
+    ]
+    if sigmoid:
+        nodes.append(("Sigmoid", ["linear"], ["prob"], {}))
+    nodes.append(("Squeeze", ["prob" if sigmoid else "linear", "squeeze_axes"], [_OUTPUT], {}))
+    out_type = TensorProto.FLOAT if dtype == np.float32 else TensorProto.DOUBLE
+    return _fuse(sc_path, nodes, initializers, out_type, out_path)
+
+def export_lr_pipeline(model_path, sc_path, out_path):
+    """Fuse a standard scaler and a statsmodels GLM trained with
+    lr_253features.train_lr_253_model into a single ONNX graph.
+    Models with an identity or logit link can be exported.
+
+    :param model_path: a path to the model's .pkl file
+    :type model_path: str
+    :param sc_path: a path to the model's standard scaler .onnx file
+    :type sc_path: str
+    :param out_path: the file path to write the pipeline to. The file
+        extension should be '.onnx', and this will be appended if it is not present
+    :type out_path: str
+    :returns: the path of the written pipeline
+    :rtype: str
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    from statsmodels.iolib.smpickle import load_pickle
+
+    out_path += (not ends_in(out_path, ".onnx")) * ".onnx"
+
+    results = load_pickle(model_path)
+    link = type(results.model.family.link).__name__
+    if link not in ('Identity', 'Logit'):
+        raise ValueError(f"Only GLMs with an identity or logit link can be exported, not {link}")
+    return _linear_pipeline(sc_path, np.asarray(results.params), 0.0, link == 'Logit', out_path)
+
+def export_los3_pipeline(model_path, sc_path, out_path):
+    """Fuse a standard scaler and the 3 feature logistic regression used by
+    ml_models.los_model_3features.LOS3Features into a single ONNX graph
+
+    :param model_path: a path to the model's .pth file
+    :type model_path: str
+    :param sc_path: a path to the model's standard scaler .onnx file
+    :type sc_path: str
+    :param out_path: the file path to write the pipeline to. The file
+        extension should be '.onnx', and this will be appended if it is not present
+    :type out_path: str
+    :returns: the path of the written pipeline
+    :rtype: str
+    """
+    def ends_in(s, ending):
+        return s[-1*len(ending):] == ending
+
+    out_path += (not ends_in(out_path, ".onnx")) * ".onnx"
+
+    state = load_state_dict(model_path, np.float64)
+    weights = state['linear.weight'].ravel()
+    bias = float(state['linear.bias'][0])
+    return _linear_pipeline(sc_path, weights, bias, True, out_path)
+
+class OnnxModel():
+    """A prediction model running a fused pipeline written by one of the
+    export functions in a single persistent onnxruntime session
+
+    :param path: a path to the pipeline's .onnx file
+    :type path: str
+    :param n_threads: the number of threads onnxruntime uses within each
+        operator. If None, onnxruntime picks its default, defaults to None
+    :type n_threads: int, optional
+    """
+    def __init__(self, path, n_threads=None):
+        """Constructor method
+        """
+        options = SessionOptions()
+        if n_threads is not None:
+            options.intra_op_num_threads = n_threads
+        self._session = InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self._input = self._session.get_inputs()[0].name
+        # Inputs are cast to the float type the pipeline was exported with
+        self._dtype = np.float32 if self._session.get_inputs()[0].type == 'tensor(float)' else np.float64
+
+    def forward(self, X):
+        """Run the model on input X
+
+        :param X: an n by n_inputs numpy array of inputs
+        :type: np.ndarray
+        :return: an n dimensional numpy array of predictions
+        :rtype: np.ndarray
+        """
+        return self._session.run([_OUTPUT], {self._input: np.asarray(X, dtype=self._dtype)})[0]
+
+class ONNX253Features(PRRModel):
+    """A PRRModel API wrapper around an OnnxModel taking the 253 feature input,
+    such as a pipeline written by export_xg_pipeline or export_lr_pipeline
+
+    :param dems: the demand points to use
+    :type dems: gpd.GeoDataFrame
+    :param facs: the gateways to use
+    :type facs: gpd.GeoDataFrame
+    :param sampler: the sampler to use
+    :type sampler: class: `iot_net_planner.geo.sampler.LinkSampler`
+    :param pipeline_path: a path to the fused pipeline's .onnx file
+    :type pipeline_path: str
+    :param ncols: the number of samples to use. The total number of
+        inputs will be ncols + 3, defaults to 250
+    :type ncols: int, optional
+    :param chunk_size: the most demand points to compute prrs for at once.
+        Keeps peak memory flat no matter how many demand points there are.
+        If None, all demand points are done at once, defaults to None
+    :type chunk_size: int, optional
+    :param dtype: the float type of the generated inputs, defaults to np.float64
+    :type dtype: np.dtype, optional
+    :param store_dir: if not None, the generated inputs are kept in a FeatureStore
+        in this directory and reused by later runs on the same terrain, defaults to None
+    :type store_dir: str, optional
+    :param n_threads: the number of threads used for inference, see OnnxModel,
+        defaults to None
+    :type n_threads: int, optional
+    """
+    def __init__(self, dems, facs, sampler, pipeline_path, ncols=250, chunk_size=None, dtype=np.float64, store_dir=None, n_threads=None):
+        self._input_gen = ML253FeaturesInput(dems, facs, sampler, ncols, chunk_size, dtype)
+        if store_dir is not None:
+            self._input_gen = FeatureStore(self._input_gen, store_dir, chunk_size=chunk_size or 4096)
+        self._dems = dems
+        self._facs = facs
+        self._sampler = sampler
+        self._ncols = ncols
+        self._model = OnnxModel(pipeline_path, n_threads)
+        self._all_dems = np.full(len(dems), True)
+
+    @property
+    def dems(self):
+        """The demand points
+
+        :return: the demand points associated with this model
+        :rtype: gpd.GeoDataFrame
+        """
+        return self._dems
+
+    @property
+    def facs(self):
+        """The gateway points
+
+        :return: the gateway points associated with this model
+        :rtype: gpd.GeoDataFrame
+        """
+        return self._facs
+
+    def get_prr(self, fac, dems=None):
+        """Get the exact prrs between fac and the self.dems[dems]
+
+        :param fac: the facility to generate prrs from
+        :type fac: int
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            the prrs to demand point i. If None, will generate to all
+            demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a numpy array with length dems.sum() of the prrs to
+            each of the demand points where dems[i]
+        :rtype: np.ndarray
+        """
+        prrs = [self._model.forward(X) for X in self._input_gen.iter_input(fac, dems)]
+        if len(prrs) == 1:
+            return prrs[0]
+        return np.concatenate(prrs)
+
+    def get_prrs(self, facs, dems=None):
+        """Get the exact prrs between each of facs and the self.dems[dems].
+        Each block of demand points is predicted for all of the facilities
+        in a single runtime call
+
+        :param facs: the facilities to generate prrs from
+        :type facs: list[int]
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            the prrs to demand point i. If None, will generate to all
+            demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a 2d numpy array with shape (dems.sum(), len(facs)) where
+            column j holds the prrs from facs[j]
+        :rtype: np.ndarray
+        """
+        if dems is None:
+            dems = self._all_dems
+        return facility_prrs(self._input_gen, self._model, facs, dems)
+
+    def get_prr_ub(self, fac, dems=None):
+        """Get an upper bound on prrs between fac and the self.dems[dems]
+
+        :param fac: the facility to generate prrs from
+        :type fac: int
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            an upper bound on the prrs to demand point i. If None,
+            will generate to all demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a numpy array with length dems.sum() of the prr upper
+            bounds to each of the demand points where dems[i]. This means
+            that self.get_prr_ub(fac) >= self.get_prr(fac)
+        :rtype: np.ndarray
+        """
+        return self.get_prr(fac, dems)
+
+    def get_prr_lb(self, fac, dems=None):
+        """Get a lower bound on prrs between fac and the self.dems[dems]
+
+        :param fac: the facility to generate prrs from
+        :type fac: int
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            a lower bound on the prrs to demand point i. If None,
+            will generate to all demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a numpy array with length dems.sum() of the prr upper
+            bounds to each of the demand points where dems[i]. This means
+            that self.get_prr_ub(fac) <= self.get_prr(fac)
+        :rtype: np.ndarray
+        """
+        return self.get_prr(fac, dems)
@@ -0,0 +1,51 @@
+"""A compact store of point coordinates and altitudes for the prediction hot path
+"""
+
+import numpy as np
+
+class PointStore():
+    """Contiguous numpy arrays of the x, y, and altitude of each point in a
+    GeoDataFrame, built once so that per-facility computations avoid pandas
+    and geopandas indexing. Points are indexed by position.
+
+    :param points: a GeoDataFrame of points
+    :type points: gpd.GeoDataFrame
+    """
+    def __init__(self, points):
+        """Constructor method
+        """
+        self.xs = np.ascontiguousarray(points.geometry.x.to_numpy(dtype=np.float64))
+        self.ys = np.ascontiguousarray(points.geometry.y.to_numpy(dtype=np.float64))
+        if 'altitude' in points:
+            self.altitudes = np.ascontiguousarray(points['altitude'].to_numpy(dtype=np.float64))
+        else:
+            self.altitudes = None
+
+    def __len__(self):
+        return len(self.xs)
+
+    def xy(self, idx=slice(None)):
+        """The coordinates of the chosen points
+
+        :param idx: an index into the points, such as a boolean mask or integer array,
+            defaults to all points
+        :type idx: np.ndarray, optional
+        :return: an n by 2 array of the x and y coordinates
+        :rtype: np.ndarray
+        """
+        return np.column_stack([self.xs[idx], self.ys[idx]])
+
+    def distances(self, x, y, idx=slice(None)):
+        """The euclidean distances from (x, y) to the chosen points
+
+        :param x: the x-coordinate to measure from
+        :type x: float
+        :param y: the y-coordinate to measure from
+        :type y: float
+        :param idx: an index into the points, such as a boolean mask or integer array,
+            defaults to all points
+        :type idx: np.ndarray, optional
+        :return: the distance to each chosen point
+        :rtype: np.ndarray
+        """
+        return np.hypot(self.xs[idx] - x, self.ys[idx] - y)
@@ -2,18 +2,24 @@
 """
 
 from iot_net_planner.prediction.prr_model import PRRModel
+from iot_net_planner.prediction.point_store import PointStore
 import numpy as np
 
 class CachedPRRModel(PRRModel):
-    def __init__(self, model):
+    def __init__(self, model, dtype=np.float64):
         """Wraps a PRRModel. Adds a caching layer to avoid regenerating prrs.
         Also provides an improve_ub method for incrementally improving upper bounds.
 
         :param model: the PRRModel instance to wrap a cache around
         :type model: class: `iot_net_planner.prediction.prr_model.PRRModel`
+        :param dtype: the float type of the cached prr matrix. np.float32 halves
+            the memory of the cache, defaults to np.float64
+        :type dtype: np.dtype, optional
         """
         self._model = model
-        self._prrs = np.zeros((len(self.dems), len(self.facs)))
+        self._dem_points = PointStore(self.dems)
+        self._fac_points = PointStore(self.facs)
+        self._prrs = np.zeros((len(self.dems), len(self.facs)), dtype=dtype)
         self._incache = np.full(self._prrs.shape, False)
         self._all_dems = np.full(len(self.dems), True)
 
@@ -38,7 +44,7 @@ class CachedPRRModel(PRRModel):
             return self._prrs[dems, fac]
         res = self._model.get_prr(fac, dems & (~in_cache))
 
-        prr = np.empty(dems.sum())
+        prr = np.empty(dems.sum(), dtype=self._prrs.dtype)
         prr[in_cache] = self._prrs[dems & in_cache, fac]
         prr[~in_cache] = res
 
@@ -47,6 +53,39 @@ class CachedPRRModel(PRRModel):
 
         return prr
 
+    def get_prrs(self, facs, dems=None):
+        """Get the exact prrs between each of facs and the self.dems[dems].
+        The facilities missing from the cache are passed to the wrapped
+        model's get_prrs together
+
+        :param facs: the facilities to generate prrs from
+        :type facs: list[int]
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            the prrs to demand point i. If None, will generate to all
+            demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a 2d numpy array with shape (dems.sum(), len(facs)) where
+            column j holds the prrs from facs[j]
+        :rtype: np.ndarray
+        """
+        if dems is None:
+            dems = self._all_dems
+        facs = np.asarray(facs, dtype=np.int64)
+        dem_idx = np.flatnonzero(dems)
+        in_cache = self._incache[np.ix_(dem_idx, facs)]
+
+        # Generate the demand points missing for any facility, for every facility missing one
+        missing_facs = facs[~np.all(in_cache, axis=0)]
+        if len(missing_facs) > 0:
+            missing = np.full(len(dems), False)
+            missing[dem_idx[~np.all(in_cache, axis=1)]] = True
+            res = self._model.get_prrs(missing_facs, missing)
+            self._prrs[np.ix_(np.flatnonzero(missing), missing_facs)] = res
+            self._incache[np.ix_(np.flatnonzero(missing), missing_facs)] = True
+
+        return self._prrs[np.ix_(dem_idx, facs)]
+
     def get_prr_ub(self, fac, dems=None):       
         """Get an upper bound on prrs between fac and the self.dems[dems]  
 
@@ -70,7 +109,7 @@ class CachedPRRModel(PRRModel):
 
         res = self._model.get_prr_ub(fac, dems & (~in_cache))
        
-        ub = np.empty(dems.sum())
+        ub = np.empty(dems.sum(), dtype=self._prrs.dtype)
         ub[in_cache] = self._prrs[dems & in_cache, fac]
         ub[~in_cache] = res
         
@@ -99,7 +138,7 @@ class CachedPRRModel(PRRModel):
 
         res = self._model.get_prr_lb(fac, dems & (~in_cache))
        
-        lb = np.empty(dems.sum())
+        lb = np.empty(dems.sum(), dtype=self._prrs.dtype)
         lb[in_cache] = self._prrs[dems & in_cache, fac]
         lb[~in_cache] = res
         
@@ -138,7 +177,7 @@ class CachedPRRModel(PRRModel):
         if np.all(in_cache):
             return
 
-        distances = np.log(self.dems.distance(self.facs.geometry[fac]).to_numpy())
+        distances = np.log(self._dem_points.distances(self._fac_points.xs[fac], self._fac_points.ys[fac]))
 
         quant_dist = np.quantile(distances, quantile)
         to_improve = (distances <= quant_dist) & (~in_cache)
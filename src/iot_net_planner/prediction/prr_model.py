@@ -81,7 +81,25 @@ class PRRModel(ABC):
         """
         pass
 
-    def save_prrs(self, filepath, logging=False):
+    def get_prrs(self, facs, dems=None):
+        """Get the exact prrs between each of facs and the self.dems[dems].
+        Models that can predict several facilities in one call override this,
+        by default get_prr is called for each facility
+
+        :param facs: the facilities to generate prrs from
+        :type facs: list[int]
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            the prrs to demand point i. If None, will generate to all
+            demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a 2d numpy array with shape (dems.sum(), len(facs)) where
+            column j holds the prrs from facs[j]
+        :rtype: np.ndarray
+        """
+        return np.column_stack([self.get_prr(fac, dems) for fac in facs])
+
+    def save_prrs(self, filepath, logging=False, dtype=np.float64, batch_size=1):
         """Saves all prrs to a numpy saved file at filepath. The file
         will contain a len(dems) x len(facs) matrix where the entry
         at [i, j] contains the prr from gateway j to demand point i
@@ -90,15 +108,22 @@ class PRRModel(ABC):
         :type filepath: str
         :param logging: whether or not to log progress, defaults to False
         :type logging: bool, optional
+        :param dtype: the float type of the saved matrix, np.float32 halves
+            the size of the file, defaults to np.float64
+        :type dtype: np.dtype, optional
+        :param batch_size: the number of facilities passed to each get_prrs
+            call, defaults to 1
+        :type batch_size: int, optional
         :return: a 2d numpy array with shape (len(dems), len(facs))
             where entry index (i, j) is the prr to the demand point i
             by the facility j
         :rtype: np.ndarray
         """
-        A = np.empty((len(self.dems), len(self.facs)))
-        for fac in range(A.shape[1]):
+        A = np.empty((len(self.dems), len(self.facs)), dtype=dtype)
+        for start in range(0, A.shape[1], batch_size):
+            stop = min(start + batch_size, A.shape[1])
             if logging:
-                print(f" {fac+1} / {A.shape[1]}", end="\r")
-            A[:, fac] = self.get_prr(fac)
+                print(f" {stop} / {A.shape[1]}", end="\r")
+            A[:, start:stop] = self.get_prrs(range(start, stop))
         np.save(filepath, A)
         
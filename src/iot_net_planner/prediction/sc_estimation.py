@@ -4,8 +4,6 @@
 from iot_net_planner.prediction.ml_253_input import ML253FeaturesInput
 
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from skl2onnx import to_onnx
     
 def estimate_sc_253features(dems, facs, sampler, sc_out, per_fac=10, logging=True):
     """Create a StandardScaler estimation for given demands and facilities.
@@ -27,6 +25,9 @@ def estimate_sc_253features(dems, facs, sampler, sc_out, per_fac=10, logging=Tru
     :param logging: whether to log progress, defaults to True
     :type logging: bool, optional
     """
+    from sklearn.preprocessing import StandardScaler
+    from skl2onnx import to_onnx
+
     def ends_in(s, ending):
         return s[-1*len(ending):] == ending
 
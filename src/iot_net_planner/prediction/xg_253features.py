@@ -1,13 +1,11 @@
 """An implementation for an xgboost ML model with 253 inputs. Credit to Alfredo Rodriguez.
 """
 from iot_net_planner.prediction.prr_model import PRRModel
-from iot_net_planner.prediction.ml_253_input import ML253FeaturesInput
+from iot_net_planner.prediction.ml_253_input import ML253FeaturesInput, facility_prrs
+from iot_net_planner.prediction.feature_store import FeatureStore
 
-from sklearn.preprocessing import StandardScaler
-from skl2onnx import to_onnx
-from onnxruntime import InferenceSession
+from onnxruntime import InferenceSession, SessionOptions
 import numpy as np
-import xgboost as xgb
 
 class XGModel():
     """A prediction model using XG boost
@@ -17,16 +15,32 @@ class XGModel():
     :param sc_file: a path to the model's standard
         scaler .onnx file
     :type sc_file: str
+    :param n_threads: the number of threads used by the scaler and the booster.
+        If None, each library picks its own default, defaults to None
+    :type n_threads: int, optional
+    :param inplace: if True, predict directly on the scaled numpy array with
+        Booster.inplace_predict instead of building a DMatrix each call,
+        defaults to True
+    :type inplace: bool, optional
     """
-    def __init__(self, path, sc_file, n_inputs=252):
+    def __init__(self, path, sc_file, n_inputs=252, n_threads=None, inplace=True):
         """Constructor method
         """
+        import xgboost as xgb
+
         self.model = xgb.Booster()
         self.model.load_model(path)
+        self._inplace = inplace
+        options = SessionOptions()
+        if n_threads is not None:
+            self.model.set_param({'nthread': n_threads})
+            options.intra_op_num_threads = n_threads
         with open(sc_file, "rb") as f:
             onx = f.read()
-        standard_scalar = InferenceSession(onx)
+        standard_scalar = InferenceSession(onx, options)
         self._sc = standard_scalar
+        # Inputs are cast to the float type the scaler was exported with
+        self._sc_dtype = np.float32 if self._sc.get_inputs()[0].type == 'tensor(float)' else np.float64
 
     def forward(self, X):
         """Run the model on input X
@@ -36,7 +50,10 @@ class XGModel():
         :return: an n dimensional numpy array of predictions
         :rtype: np.ndarray
         """
-        X = self._sc.run(None, {"X": X})[0]
+        X = self._sc.run(None, {"X": np.asarray(X, dtype=self._sc_dtype)})[0]
+        if self._inplace:
+            return self.model.inplace_predict(X)
+        import xgboost as xgb
         dmat = xgb.DMatrix(X)
         return self.model.predict(dmat)
 
@@ -56,14 +73,30 @@ class XG253Features(PRRModel):
     :param ncols: the number of samples to use. The total number of
         inputs will be ncols + 3, defaults to 250
     :type ncols: int, optional
+    :param chunk_size: the most demand points to compute prrs for at once.
+        Keeps peak memory flat no matter how many demand points there are.
+        If None, all demand points are done at once, defaults to None
+    :type chunk_size: int, optional
+    :param dtype: the float type of the generated inputs. Use np.float32 with a
+        scaler exported for float32 inputs to avoid any conversion, defaults to np.float64
+    :type dtype: np.dtype, optional
+    :param store_dir: if not None, the generated inputs are kept in a FeatureStore
+        in this directory and reused by later runs on the same terrain, even with
+        a different model, defaults to None
+    :type store_dir: str, optional
+    :param n_threads: the number of threads used for inference, see XGModel,
+        defaults to None
+    :type n_threads: int, optional
     """
-    def __init__(self, dems, facs, sampler, model_path, sc_path, ncols=250):
-        self._input_gen = ML253FeaturesInput(dems, facs, sampler, ncols)
+    def __init__(self, dems, facs, sampler, model_path, sc_path, ncols=250, chunk_size=None, dtype=np.float64, store_dir=None, n_threads=None):
+        self._input_gen = ML253FeaturesInput(dems, facs, sampler, ncols, chunk_size, dtype)
+        if store_dir is not None:
+            self._input_gen = FeatureStore(self._input_gen, store_dir, chunk_size=chunk_size or 4096)
         self._dems = dems
         self._facs = facs
         self._sampler = sampler
         self._ncols = ncols
-        self._model = XGModel(model_path, sc_path)
+        self._model = XGModel(model_path, sc_path, n_threads=n_threads)
         self._all_dems = np.full(len(dems), True)
 
     @property
@@ -98,7 +131,30 @@ class XG253Features(PRRModel):
             each of the demand points where dems[i]
         :rtype: np.ndarray
         """
-        return self._model.forward(self._input_gen.get_input(fac, dems))
+        prrs = [self._model.forward(X) for X in self._input_gen.iter_input(fac, dems)]
+        if len(prrs) == 1:
+            return prrs[0]
+        return np.concatenate(prrs)
+
+    def get_prrs(self, facs, dems=None):
+        """Get the exact prrs between each of facs and the self.dems[dems].
+        Each block of demand points is predicted for all of the facilities
+        in a single call
+
+        :param facs: the facilities to generate prrs from
+        :type facs: list[int]
+        :param dems: a boolean numpy array with length equal to the
+            number of demand points, dems[i] == True means to generate
+            the prrs to demand point i. If None, will generate to all
+            demand points, defaults to None
+        :type dems: np.ndarray, optional
+        :return: a 2d numpy array with shape (dems.sum(), len(facs)) where
+            column j holds the prrs from facs[j]
+        :rtype: np.ndarray
+        """
+        if dems is None:
+            dems = self._all_dems
+        return facility_prrs(self._input_gen, self._model, facs, dems)
 
     def get_prr_ub(self, fac, dems=None):
         """Get an upper bound on prrs between fac and the self.dems[dems]  
@@ -134,7 +190,7 @@ class XG253Features(PRRModel):
         """
         return self.get_prr(fac, dems)
 
-def train_xg_253_model(X_train, y_train, sc_out, xg_out, num_round=1000):
+def train_xg_253_model(X_train, y_train, sc_out, xg_out, num_round=1000, dtype=np.float64):
     """Train an xg_boost model on data X and y. Generates
     a standard scaler (sc) model and an xg boost model.
     Both of these models need to be used to construct
@@ -156,7 +212,14 @@ def train_xg_253_model(X_train, y_train, sc_out, xg_out, num_round=1000):
     :param num_round: int for how many training rounds to perform,
         defaults to 1000
     :type num_round: int, optional
+    :param dtype: the float type the exported scaler takes as input,
+        defaults to np.float64
+    :type dtype: np.dtype, optional
     """
+    import xgboost as xgb
+    from sklearn.preprocessing import StandardScaler
+    from skl2onnx import to_onnx
+
     def ends_in(s, ending):
         return s[-1*len(ending):] == ending
 
@@ -165,7 +228,7 @@ def train_xg_253_model(X_train, y_train, sc_out, xg_out, num_round=1000):
 
     sc = StandardScaler()
     X_train = sc.fit_transform(X_train)
-    onx = to_onnx(sc, X_train[:1].astype(np.double))
+    onx = to_onnx(sc, X_train[:1].astype(dtype))
     if sc_out != ".onnx":
         with open(sc_out, "wb") as f:
             f.write(onx.SerializeToString())